@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+#
+# 	 dwhwrapper - cli wrapper for Teradata data warehouse utilities (BTEQ,etc..)
+#    Copyright (C) 2012 Felix Barbalet, Corporate Analytics, Australian Taxation Office, Commonwealth of Australia
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    tdbroker.py - keeps cliv2 sessions logged on between dwh runs
+#
+#    * 'dwh broker' runs a broker listening on a unix socket (~/.dwh_cache/broker.sock)
+#    * sessions are pooled per dbc/user/password, evicted when idle and
+#      checked before they are reused
+#    * get_ddf and 'dwh get --direct' borrow sessions from a running broker
+#      instead of logging on themselves
+#
+#    Each request is one connection: the client sends a 'Q' frame holding a
+#    json request, the broker answers with 'P' (PrepInfo parcel), 'R' (record)
+#    and 'D' (done) frames, or an 'E' frame with an error message.
+#    A frame is a one byte kind, a 4 byte length and the payload.
+
+import socket
+import SocketServer
+import struct
+import threading
+import hashlib
+import json
+import time
+import os
+
+from tdcli import dbc_connection
+
+SOCKET_PATH = os.path.join(os.path.expanduser('~'),'.dwh_cache','broker.sock')
+
+frame_header = struct.Struct('=cI')
+
+def send_frame(sock,kind,payload=''):
+	sock.sendall(frame_header.pack(kind,len(payload)) + payload)
+
+def read_frame(f):
+	"""returns (kind,payload) of the next frame from file object f"""
+
+	header = f.read(frame_header.size)
+
+	if len(header) != frame_header.size:
+		raise Exception('Connection to dwh broker closed')
+
+	kind,plen = frame_header.unpack(header)
+	payload = f.read(plen)
+
+	if len(payload) != plen:
+		raise Exception('Connection to dwh broker closed')
+
+	return kind,payload
+
+class session_pool:
+	"""logged on dbc_connections for one dbc/user
+
+	size - maximum sessions logged on at once
+	check_after - sessions idle for longer than this many seconds are
+				  checked with a trivial query before they are reused"""
+
+	def __init__(self,dbc,uid,pw,size,check_after=60):
+		self.logon_details = (dbc,uid,pw)
+		self.check_after = check_after
+		self.idle = []				#(dbc_connection,time returned)
+		self.lock = threading.Lock()
+		self.slots = threading.Semaphore(size)
+
+	def borrow(self):
+		"""returns an idle session, or a new one if none are idle - blocks
+		while all of the pool's sessions are in use"""
+
+		self.slots.acquire()
+
+		try:
+			while True:
+				with self.lock:
+					if len(self.idle) == 0:
+						break
+					dbcc,returned = self.idle.pop()
+
+				if time.time() - returned < self.check_after or self.healthy(dbcc):
+					return dbcc
+
+				self.discard(dbcc)
+
+			dbcc = dbc_connection()
+			dbcc.logon(*self.logon_details)
+			return dbcc
+		except:
+			self.slots.release()
+			raise
+
+	def give_back(self,dbcc,reuse):
+		"""returns a borrowed session to the pool - sessions that failed a
+		request (reuse=False) are logged off instead"""
+
+		if reuse is True:
+			with self.lock:
+				self.idle.append((dbcc,time.time()))
+		else:
+			self.discard(dbcc)
+
+		self.slots.release()
+
+	def evict(self,idle_secs):
+		"""logs off sessions idle for more than idle_secs
+
+		returns the number of sessions still idle in the pool"""
+
+		cutoff = time.time() - idle_secs
+
+		with self.lock:
+			expired = [dbcc for dbcc,returned in self.idle if returned < cutoff]
+			self.idle = [(dbcc,returned) for dbcc,returned in self.idle if returned >= cutoff]
+			remaining = len(self.idle)
+
+		for dbcc in expired:
+			self.discard(dbcc)
+
+		return remaining
+
+	def healthy(self,dbcc):
+		try:
+			for record in dbcc.fetch_records('SELECT 1;'):
+				pass
+		except Exception:
+			return False
+
+		return True
+
+	def discard(self,dbcc):
+		try:
+			dbcc.logout()
+		except Exception:
+			pass
+
+class broker_handler(SocketServer.StreamRequestHandler):
+	"""serves a single request from a dwh client"""
+
+	def handle(self):
+
+		try:
+			kind,payload = read_frame(self.rfile)
+			request = json.loads(payload)
+			op = request['op']
+
+			if op == 'ping':
+				send_frame(self.request,'D')
+				return
+
+			pool = self.server.get_pool(*[request[k].encode('latin-1') for k in ['dbc','uid','pw']])
+			sql = request['sql'].encode('latin-1')
+			dbcc = pool.borrow()
+		except Exception as e:
+			self.error(e)
+			return
+
+		reuse = False
+
+		try:
+			if op == 'prepinfo':
+				parcel,plen = dbcc.get_prepinfo_parcel(sql)
+				send_frame(self.request,'P',parcel.raw[:plen])
+			elif op == 'records':
+				for record in dbcc.fetch_records(sql):
+					send_frame(self.request,'R',record)
+			else:
+				raise Exception("Unknown broker request '{0}'".format(op))
+
+			reuse = True
+		except Exception as e:
+			self.error(e)
+		finally:
+			pool.give_back(dbcc,reuse)
+
+		#only once the session is idle again, so the client's next request
+		#can reuse it
+		if reuse is True:
+			try:
+				send_frame(self.request,'D')
+			except socket.error:
+				pass
+
+	def error(self,e):
+		try:
+			send_frame(self.request,'E',str(e))
+		except socket.error:
+			pass
+
+class broker(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+	"""pools logged on sessions for dwh clients
+
+	pool_size - maximum sessions per dbc/user
+	idle_secs - sessions idle for longer than this are logged off"""
+
+	daemon_threads = True
+
+	def __init__(self,socket_path=None,pool_size=4,idle_secs=600,verbose=False):
+
+		if socket_path is None:
+			socket_path = SOCKET_PATH
+
+		socket_dir = os.path.dirname(socket_path)
+
+		if not os.path.isdir(socket_dir):
+			os.makedirs(socket_dir,0700)
+
+		if os.path.exists(socket_path):
+			if broker_client(socket_path).ping() is True:
+				raise Exception("A dwh broker is already listening on '{0}'".format(socket_path))
+			os.remove(socket_path)
+
+		#only the owner may connect
+		umask = os.umask(0177)
+		try:
+			SocketServer.UnixStreamServer.__init__(self,socket_path,broker_handler)
+		finally:
+			os.umask(umask)
+
+		self.socket_path = socket_path
+		self.pool_size = pool_size
+		self.idle_secs = idle_secs
+		self.verbose = verbose
+		self.pools = {}
+		self.pools_lock = threading.Lock()
+
+	def get_pool(self,dbc,uid,pw):
+
+		#the password is part of the key, so a session is only ever lent to
+		#a client that could have logged it on itself
+		key = (dbc.lower(),uid.lower(),hashlib.sha1(pw).hexdigest())
+
+		with self.pools_lock:
+			if key not in self.pools:
+				if self.verbose is True:
+					print '--- new session pool for {0}@{1}'.format(uid,dbc)
+				self.pools[key] = session_pool(dbc,uid,pw,self.pool_size)
+			return self.pools[key]
+
+	def evict_idle(self):
+		while True:
+			time.sleep(max(1,min(self.idle_secs,60)))
+
+			with self.pools_lock:
+				pools = self.pools.items()
+
+			for key,pool in pools:
+				remaining = pool.evict(self.idle_secs)
+				if self.verbose is True:
+					print '--- {0}@{1}: {2} idle session(s)'.format(key[1],key[0],remaining)
+
+	def serve(self):
+		"""serves requests until interrupted, then logs off all sessions"""
+
+		evictor = threading.Thread(target=self.evict_idle)
+		evictor.daemon = True
+		evictor.start()
+
+		try:
+			self.serve_forever()
+		finally:
+			self.server_close()
+			os.remove(self.socket_path)
+
+			for pool in self.pools.values():
+				pool.evict(-1)
+
+class broker_client:
+	"""talks to a running broker"""
+
+	def __init__(self,socket_path=None,timeout=None):
+		self.socket_path = socket_path if socket_path is not None else SOCKET_PATH
+		self.timeout = timeout
+
+	def request(self,request):
+		"""sends request and yields the (kind,payload) of each reply frame
+		up to the 'D' frame - an 'E' frame is raised as an exception"""
+
+		sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		sock.settimeout(self.timeout)
+
+		try:
+			sock.connect(self.socket_path)
+			send_frame(sock,'Q',json.dumps(request))
+
+			replies = sock.makefile('rb')
+
+			while True:
+				kind,payload = read_frame(replies)
+
+				if kind == 'D':
+					break
+				elif kind == 'E':
+					raise Exception(payload)
+
+				yield kind,payload
+		finally:
+			sock.close()
+
+	def ping(self):
+		try:
+			for reply in self.request({'op':'ping'}):
+				pass
+		except Exception:
+			return False
+
+		return True
+
+class broker_session:
+	"""stands in for a logged on dbc_connection, sending each request to the
+	broker - each request borrows a pooled session only while it runs"""
+
+	def __init__(self,client,dbc,uid,pw):
+		self.client = client
+		self.logon_details = {'dbc':dbc,'uid':uid,'pw':pw}
+
+	def request(self,op,sql):
+		request = {'op':op,'sql':sql}
+		request.update(self.logon_details)
+		return self.client.request(request)
+
+	def get_prepinfo_parcel(self,sql):
+		parcel = None
+
+		for kind,payload in self.request('prepinfo',sql):
+			if kind == 'P':
+				parcel = payload
+
+		if parcel is None:
+			raise Exception('No PrepInfo parcel from dwh broker')
+
+		return (parcel,len(parcel))
+
+	def fetch_records(self,sql):
+		for kind,record in self.request('records',sql):
+			yield record
+
+	def logout(self):
+		pass
+
+def borrow(dbc,uid,pw,socket_path=None):
+	"""returns a broker_session if a broker is listening on socket_path
+	(by default SOCKET_PATH), otherwise None"""
+
+	if socket_path is None:
+		socket_path = SOCKET_PATH
+
+	if not os.path.exists(socket_path):
+		return None
+
+	client = broker_client(socket_path)
+
+	if client.ping() is False:
+		return None
+
+	return broker_session(client,dbc,uid,pw)
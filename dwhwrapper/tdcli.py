@@ -22,18 +22,49 @@
 #    * queries teradata to retreive datatypes returned by a query
 #    * packs/unpacks common sql types from teradata binary format used by fexp
 
+import sys
 import ctypes
 import struct
 import csv
 import string
 import re
+import os
+import shutil
+import threading
+import Queue
+import time
+import json
+import hashlib
+import binascii
+import random
+import heapq
+
+import tdmetrics
 
 #Only the following data types are supported currently
 SUPPORTED_TYPES = ('VARCHAR','CHAR','DECIMAL','FLOAT',
 				   'INTEGER','SMALLINT','DATE','BYTEINT')
 
-#dbcarea is generated upon install because it is architecture dependent
-from dbcarea import dbc_area
+#numpy is optional - exports without VARCHAR columns are decoded a block
+#at a time when it's available. It's imported by load_numpy when a
+#conversion first needs it, as it takes longer to import than most dwh
+#commands take to run
+numpy = None
+numpy_loaded = False
+
+def load_numpy():
+	"""returns the numpy module, or None if it isn't installed"""
+	
+	global numpy,numpy_loaded
+	
+	if numpy_loaded is False:
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+		numpy_loaded = True
+	
+	return numpy
 
 class cli_failure(ctypes.Structure):
 	_fields_ = [
@@ -44,6 +75,13 @@ class cli_failure(ctypes.Structure):
 		,	("Msg",ctypes.c_char * 255)
 	]
 
+def load_cliv2():
+	"""returns the cliv2 library a dbc_connection uses if it isn't given one
+	- libcliv2.so, or the library named by the DWH_CLIV2_LIB environment
+	variable ('tdemu.py dwh' replaces this to use its emulator)"""
+	
+	return ctypes.cdll.LoadLibrary(os.environ.get('DWH_CLIV2_LIB','libcliv2.so'))
+
 class dbc_connection:
 	"""Connects to the dbc using libcliv2.so
 	Code based on the Teradata sample.c and heavily modified"""
@@ -68,13 +106,25 @@ class dbc_connection:
 	
 	REQEXHAUST=307
 	
-	def __init__(self):
-		self.dbcarea = dbc_area()
+	def __init__(self,cli=None):
+		"""cli - the loaded cliv2 library, by default load_cliv2()"""
+		
+		if cli is None:
+			cli = load_cliv2()
+		self.cli = cli
+		
+		#the emulator brings its own dbcarea layout, otherwise it's the one
+		#generated upon install because it is architecture dependent - only
+		#imported once a session is needed
+		area = getattr(cli,'dbc_area',None)
+		if area is None:
+			from dbcarea import dbc_area as area
+		
+		self.dbcarea = area()
 		self.dbcarea.total_len = ctypes.sizeof(self.dbcarea)
 		self.result = ctypes.c_int(self.EM_OK)
 		
 		self.cnta = ctypes.c_int32(0)
-		self.cli = ctypes.cdll.LoadLibrary("libcliv2.so")
 		
 		self.cli.DBCHINI(ctypes.byref(self.result),ctypes.byref(self.cnta),ctypes.byref(self.dbcarea))
 	
@@ -190,6 +240,67 @@ class dbc_connection:
 		self.close_request()
 		
 		return (parcel,rlen)
+	
+	def fetch_records(self,sql):
+		"""executes sql and yields the data of each PclRECORD parcel
+		- in indicator mode the data is laid out like a row of a bteq
+		  INDICDATA export, without the length and end of record newline"""
+		
+		self.dbcarea.req_proc_opt = 'E'
+		
+		try:
+			self.submit_sql_request(sql)
+			
+			while True:
+				
+				self.result = self.fetch_request([self.PclRECORD])
+				
+				if self.result == self.REQEXHAUST:
+					break
+				
+				yield ctypes.string_at(self.dbcarea.fet_data_ptr,self.dbcarea.fet_ret_data_len)
+			
+			self.close_request()
+		finally:
+			self.dbcarea.req_proc_opt = 'P'
+
+	def execute_using(self,sql,using_data):
+		"""executes sql with using_data sent as its indicator mode data
+		
+		returns the activity count of each statement in the request"""
+		
+		using = ctypes.create_string_buffer(using_data,len(using_data))
+		self.dbcarea.using_data_ptr = ctypes.cast(using,ctypes.POINTER(ctypes.c_char))
+		self.dbcarea.using_data_len = len(using_data)
+		self.dbcarea.req_proc_opt = 'E'
+		
+		counts = []
+		
+		try:
+			self.submit_sql_request(sql)
+			
+			while True:
+				
+				self.result = self.fetch_request([self.PclSUCCESS,self.PclOK])
+				
+				if self.result == self.REQEXHAUST:
+					break
+				
+				parcel = ctypes.string_at(self.dbcarea.fet_data_ptr,self.dbcarea.fet_ret_data_len)
+				
+				#StatementNo,ActivityCount,.. for success - StatementNo,FieldCount,ActivityCount,.. for ok
+				if self.result == self.PclSUCCESS:
+					counts.append(struct.unpack_from('=HI',parcel)[1])
+				else:
+					counts.append(struct.unpack_from('=HHI',parcel)[2])
+			
+			self.close_request()
+		finally:
+			self.dbcarea.using_data_ptr = None
+			self.dbcarea.using_data_len = 0
+			self.dbcarea.req_proc_opt = 'P'
+		
+		return counts
 
 	def logout(self):
 		
@@ -291,10 +402,33 @@ class PrepInfoColumn:
 		
 		return		
 				
-def get_ddf(c_sql,dbc,uid,pw,args):
+def open_session(dbc,uid,pw,args):
+	"""returns a session borrowed from the dwh broker if one is running
+	(see tdbroker.py), otherwise a newly logged on dbc_connection"""
+	
+	if getattr(args,'no_broker',False) is False:
+		import tdbroker
+		
+		session = tdbroker.borrow(dbc,uid,pw)
+		
+		if session is not None:
+			if args.verbose is True:
+				print '--- using dwh broker'
+			return session
+	
+	with tdmetrics.stage('logon'):
+		dbcc = dbc_connection()
+		dbcc.logon(dbc,uid,pw)
+	
+	return dbcc
+
+def fetch_ddf(c_sql,dbc,uid,pw,args,dbcc=None):
 	"""Connects to 'dbc' using credentials 'uid' and 'pw', and runs a
 	PrepInfoQuery using the sql query supplied
 	
+	dbcc - an already logged on dbc_connection to use instead, which is
+		   left logged on
+	
 	returns a dictionary containing:
 	- sql_query : the query
 	- cost_est : the cost estimate
@@ -309,20 +443,24 @@ def get_ddf(c_sql,dbc,uid,pw,args):
 			- Format 	: SQL format description
 			"""
 
-	if args.verbose:
-		print '--- opening connection to retreive PrepInfoParcel'
-		
-	dbcc = dbc_connection()
-	if args.verbose:
-		print '--- logon'
-	dbcc.logon(dbc,uid,pw)
-	if args.verbose is True:
-		print "SQL: '{0}'".format(c_sql)
-	parcel,plen = dbcc.get_prepinfo_parcel(c_sql)
-	if args.verbose:
-		print '--- logout'
-	dbcc.logout()	
-	del dbcc
+	if dbcc is not None:
+		if args.verbose is True:
+			print "SQL: '{0}'".format(c_sql)
+		parcel,plen = dbcc.get_prepinfo_parcel(c_sql)
+	else:
+		if args.verbose:
+			print '--- opening connection to retreive PrepInfoParcel'
+			
+		if args.verbose:
+			print '--- logon'
+		dbcc = open_session(dbc,uid,pw,args)
+		if args.verbose is True:
+			print "SQL: '{0}'".format(c_sql)
+		parcel,plen = dbcc.get_prepinfo_parcel(c_sql)
+		if args.verbose:
+			print '--- logout'
+		dbcc.logout()	
+		del dbcc
 
 	if plen == 0:
 		raise Exception('Unable to retreive PrepInfo parcel')
@@ -366,20 +504,254 @@ def get_ddf(c_sql,dbc,uid,pw,args):
 		,'ddf'		:ddf
 	}
 
+#a quoted literal or identifier (group 1), or a comment
+sql_quoted_or_comment = re.compile('(\'(?:[^\']|\'\')*\'|"(?:[^"]|"")*")|--[^\r\n]*|/\*[\w\W]*?\*/')
+
+def normalise_sql(sql):
+	"""normalises sql for use as a cache key - comments, extra whitespace
+	and trailing semi-colons are removed and everything outside of quoted
+	literals and identifiers is lower-cased
+	
+	quoted spans are kept exactly, as eg 'a  b' and 'a b' differ in length"""
+	
+	#unquoted text at even indexes, quoted spans at odd
+	spans = ['']
+	pos = 0
+	
+	for m in sql_quoted_or_comment.finditer(sql):
+		spans[-1] += sql[pos:m.start()]
+		if m.group(1) is None:
+			spans[-1] += ' '
+		else:
+			spans.extend([m.group(1),''])
+		pos = m.end()
+	
+	spans[-1] += sql[pos:]
+	
+	for i in range(0,len(spans),2):
+		spans[i] = re.sub('[\s]+',' ',spans[i]).lower()
+	
+	return ''.join(spans).strip().rstrip('; ')
+
+DDF_CACHE_DIR = os.path.join(os.path.expanduser('~'),'.dwh_cache','ddf')
+
+class ddf_cache:
+	"""on-disk cache of get_ddf results, keyed by dbc, user and normalised
+	sql, so repeated runs can skip the PrepInfo logon
+	
+	ttl - seconds an entry is valid for
+	cache_dir - defaults to DDF_CACHE_DIR (~/.dwh_cache/ddf)"""
+	
+	def __init__(self,ttl,cache_dir=None):
+		
+		if cache_dir is None:
+			cache_dir = DDF_CACHE_DIR
+		
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir,0700)
+		
+		self.ttl = ttl
+		self.cache_dir = cache_dir
+		
+	def filename(self,dbc,uid,sql):
+		key = '\n'.join([dbc.lower(),uid.lower(),normalise_sql(sql)])
+		return os.path.join(self.cache_dir,'{0}.json'.format(hashlib.sha1(key).hexdigest()))
+	
+	def get(self,dbc,uid,sql,last_alter=None):
+		"""returns the cached result, or None if it's missing, older than the
+		ttl or was cached when the table had a different last_alter"""
+		
+		try:
+			with open(self.filename(dbc,uid,sql),'r') as f:
+				entry = json.load(f,encoding='latin-1')
+		except (IOError,ValueError):
+			return None
+		
+		if time.time() - entry['cached'] > self.ttl:
+			return None
+		
+		if last_alter is not None and entry['last_alter'] != last_alter:
+			return None
+		
+		return self.to_str(entry['result'])
+	
+	def put(self,dbc,uid,sql,result,last_alter=None):
+		
+		entry = {'cached':time.time(),'last_alter':last_alter,'result':result}
+		filename = self.filename(dbc,uid,sql)
+		
+		#write then rename, so concurrent runs never read half an entry
+		tmp = '{0}.{1}'.format(filename,os.getpid())
+		fd = os.open(tmp,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0600)
+		with os.fdopen(fd,'w') as f:
+			json.dump(entry,f,encoding='latin-1')
+		os.rename(tmp,filename)
+	
+	def to_str(self,value):
+		"""json returns unicode, but the rest of tdcli works with latin-1 str"""
+		
+		if isinstance(value,unicode):
+			return value.encode('latin-1')
+		elif isinstance(value,list):
+			return [self.to_str(v) for v in value]
+		elif isinstance(value,dict):
+			return dict((self.to_str(k),self.to_str(v)) for k,v in value.iteritems())
+		return value
+
+def table_last_alter(dbcc,table):
+	"""returns the LastAlterTimeStamp of table (database.table or table in
+	the default database) as a string, or None if it wasn't found"""
+	
+	if '.' in table:
+		database,table = table.split('.',1)
+		database = "'{0}'".format(database)
+	else:
+		database = 'DATABASE'
+	
+	sql = "SELECT CAST(MAX(LastAlterTimeStamp) AS CHAR(26)) FROM DBC.TablesV " \
+			"WHERE DatabaseName = {0} AND TableName = '{1}';".format(database,table)
+	
+	last_alter = None
+	
+	for record in dbcc.fetch_records(sql):
+		#one indicator byte then the CHAR(26)
+		if ord(record[0]) & 0x80 == 0:
+			last_alter = record[1:27]
+	
+	return last_alter
+
+def get_ddf(c_sql,dbc,uid,pw,args,dbcc=None,table=None):
+	"""returns the fetch_ddf result for c_sql, from the ddf cache if
+	args.ddf_cache_ttl is set and the cached entry is still valid
+	
+	table - the table c_sql selects from, if its last alter time should be
+			checked against the cached entry (args.ddf_cache_check)"""
+	
+	ttl = getattr(args,'ddf_cache_ttl',0)
+	
+	if ttl <= 0:
+		return fetch_ddf(c_sql,dbc,uid,pw,args,dbcc)
+	
+	cache = ddf_cache(ttl)
+	last_alter = None
+	logout = False
+	
+	try:
+		if table is not None and getattr(args,'ddf_cache_check',False) is True:
+			if dbcc is None:
+				dbcc = open_session(dbc,uid,pw,args)
+				logout = True
+			last_alter = table_last_alter(dbcc,table)
+		
+		result = cache.get(dbc,uid,c_sql,last_alter)
+		
+		if result is not None:
+			if args.verbose is True:
+				print '--- using cached ddf'
+			#the cached query may differ in case/whitespace
+			result['sql_query'] = c_sql
+			return result
+		
+		result = fetch_ddf(c_sql,dbc,uid,pw,args,dbcc)
+		cache.put(dbc,uid,c_sql,result,last_alter)
+		
+		return result
+	finally:
+		if logout is True:
+			dbcc.logout()
+
+class conversion_cache:
+	"""bounded memo of a conversion function for a single column
+	- an approximate LRU: entries are kept in a young and an old generation,
+	  when the young generation fills up the old one is dropped and the young
+	  one becomes old - an entry used in the old generation moves to the young
+	- hits and misses are counted, and the cache turns itself off if fewer
+	  than 1 in 10 lookups hit once it has missed size times"""
+	
+	def __init__(self,function,size=4096):
+		self.function = function
+		self.size = size
+		self.young = {}
+		self.old = {}
+		self.hits = self.misses = 0
+		self.enabled = True
+	
+	def __call__(self,value):
+		
+		if self.enabled is False:
+			return self.function(value)
+		
+		try:
+			result = self.young[value]
+			self.hits += 1
+			return result
+		except KeyError:
+			pass
+		
+		try:
+			result = self.old[value]
+			self.hits += 1
+		except KeyError:
+			result = self.function(value)
+			self.misses += 1
+			
+			if self.misses == self.size and self.hits < self.misses / 9:
+				self.enabled = False
+				self.young = self.old = {}
+				return result
+		
+		self.young[value] = result
+		
+		if len(self.young) >= self.size / 2:
+			self.old = self.young
+			self.young = {}
+		
+		return result
+
 class td_type:
 	"""base class for teradata binary types"""
 	
 	fd = None					#stores the field description
 	data_type = None			#stores the field type for cstruct calls
 	data_length = None			#stores the field length for cstruct calls
+	converts = False			#True if convert() changes the unpacked value
+	memoise = ()				#methods wrapped by a conversion_cache per column
 	
 	def __init__(self,field_defintion):
 		self.fd = field_defintion
 		self.data_type = self.data_length = None
 		
+		for name in self.memoise:
+			setattr(self,name,conversion_cache(getattr(self,name)))
+	
+	def cache_stats(self):
+		"""returns a list of (method,hits,misses) for each memoised method"""
+		return [(name,getattr(self,name).hits,getattr(self,name).misses) for name in self.memoise]
+		
 	def unpack(self,row_data,offset):
 		data = struct.unpack_from(self.data_type,row_data,offset)[0]
 		return data,self.data_length
+	
+	def convert(self,row_item):
+		"""convert an unpacked value to its csv representation"""
+		return row_item
+	
+	def encode(self,r):
+		"""convert a csv value to the value packed in binary format"""
+		return r
+	
+	def pack(self,rph,r):
+		rph.add_data(td_type=self,data=self.encode(r))
+	
+	def convert_array(self,values):
+		"""convert a numpy array of unpacked values to a sequence of their csv
+		representations - the whole column of a block at once"""
+		return values.tolist()
+	
+	def typed_array(self,values):
+		"""convert a numpy array of unpacked values to the array written
+		for columnar output"""
+		return values
 		
 class type_float(td_type):
 	
@@ -392,8 +764,8 @@ class type_float(td_type):
 		assert(self.data_length == 8) #Teradata stores floats as 8bytes only?
 		self.data_type = dlmap[self.data_length]
 		
-	def pack(self,rph,r):
-		rph.add_data(td_type=self,data=float(r))
+	def encode(self,r):
+		return float(r)
 	
 class type_integer(td_type):
 	
@@ -402,8 +774,8 @@ class type_integer(td_type):
 		self.data_type = 'i'
 		self.data_length = 4
 		
-	def pack(self,rph,r):
-		rph.add_data(td_type=self,data=int(r))
+	def encode(self,r):
+		return int(r)
 		
 class type_smallint(type_integer):
 	"""like an integer, but half the size"""
@@ -424,10 +796,15 @@ class type_byteint(type_integer):
 class type_date(type_integer):
 	"""dates are stored as integers - we overwrite the pack/unpack function"""
 	
-	def pack(self,rph,r):
+	converts = True
+	memoise = ('encode','convert')
+	
+	date_format = re.compile('^[\s]*([0-9]{2,4})(?:-|/)([0-9]{1,2})(?:-|/)([0-9]{1,2})[\s]*$')
+	
+	def encode(self,r):
 		
 		try:
-			(yr,month,day)=re.compile('^[\s]*([0-9]{2,4})(?:-|/)([0-9]{1,2})(?:-|/)([0-9]{1,2})[\s]*$').match(r).groups()
+			(yr,month,day)=self.date_format.match(r).groups()
 		except AttributeError:
 			raise AttributeError("Dates from column '{0}' are not in ISO Standard YYYY-MM-DD format (or other recognizable form); '{1}'".format(self.fd['Name'],r))
 			
@@ -441,11 +818,14 @@ class type_date(type_integer):
 			
 		ri = (int(yr) - 1900) * 10000 + (int(month) * 100) + int(day)
 		
-		rph.add_data(td_type=self,data=ri)
+		return ri
 	
 	def unpack(self,row_data,offset):
 		
 		row_item,new_offset = td_type.unpack(self,row_data,offset)
+		return self.convert(row_item),new_offset
+	
+	def convert(self,row_item):
 		
 		#(YEAR - 1900) * 10000 + (MONTH * 100) + DAY
 		yr =   (row_item / 10000) + 1900
@@ -453,7 +833,26 @@ class type_date(type_integer):
 		day = 	row_item -		 (row_item / 100) 	* 100
 		
 		#ANSI format YYYY-MM-DD
-		return '{0:04}-{1:02}-{2:02}'.format(yr,month,day),new_offset
+		return '{0:04}-{1:02}-{2:02}'.format(yr,month,day)
+	
+	def convert_array(self,values):
+		
+		#a block holds few distinct dates, so only convert each one once
+		dates,index = numpy.unique(values,return_inverse=True)
+		
+		return numpy.array([self.convert(d) for d in dates.tolist()],dtype=object)[index]
+	
+	def typed_array(self,values):
+		
+		values = values.astype('i8')
+		
+		yr = values // 10000 + 1900
+		month = values // 100 - (values // 10000) * 100
+		day = values - (values // 100) * 100
+		
+		months = (yr - 1970).astype('M8[Y]').astype('M8[M]') + (month - 1).astype('m8[M]')
+		
+		return months.astype('M8[D]') + (day - 1).astype('m8[D]')
 
 class type_varchar(td_type):
 	
@@ -462,12 +861,18 @@ class type_varchar(td_type):
 		self.data_type = 'H'
 		self.data_length = 2
 	
-	def pack(self,rph,r):
+	def encode(self,r):
 				
 		if len(r) > self.fd['Len']:
 			raise ValueError("Column '{0}' contains a string longer than {1} characters".format(
 				self.fd['Name'],self.fd['Len']))
 		
+		return r
+	
+	def pack(self,rph,r):
+		
+		r = self.encode(r)
+		
 		rph.add_custom_data(self.data_type,self.data_length,len(r))
 		
 		for i in range(0,len(r)):
@@ -485,27 +890,41 @@ class type_varchar(td_type):
 
 class type_char(td_type):	
 	
+	memoise = ('encode',)
+	
 	def __init__(self,field_definition):
 		td_type.__init__(self,field_definition)
 		#self.data_type = 'c'
 		self.data_type = '{0}s'.format(self.fd['Len'])
 		self.data_length = self.fd['Len']
 		
-	def pack(self,rph,r):
+	def encode(self,r):
 				
 		if len(r) > self.fd['Len']:
-			raise ValueError("Column '{0}' contains a string longer than {1} characters".format(d['Name'],d['Len']))
+			raise ValueError("Column '{0}' contains a string longer than {1} characters".format(
+				self.fd['Name'],self.fd['Len']))
 			
-		rph.add_data(self,r.ljust(self.fd['Len']))
+		return r.ljust(self.fd['Len'])
 	
 	def unpack(self,row_data,offset):
 		
 		row_item = row_data[offset : offset + self.data_length]
 		return row_item,self.data_length
+	
+	def convert_array(self,values):
+		
+		#values are the bytes of each row, as a (rows,length) array
+		data = numpy.ascontiguousarray(values).tobytes()
+		n = self.data_length
+		
+		return [data[i : i + n] for i in xrange(0,len(data),n)]
 
 class type_decimal(td_type):
 	"""decimal type"""
 	
+	converts = True
+	memoise = ('encode','convert')
+	
 	def __init__(self,field_definition):
 		td_type.__init__(self,field_definition)
 
@@ -535,7 +954,7 @@ class type_decimal(td_type):
 		
 		raise Exception('Decimals with precision > 18 not supported - col {0}'.format(self.fd['Name']))
 		
-	def pack(self,rph,r):
+	def encode(self,r):
 				
 		precis = self.fd['Len'][0]
 		scale = self.fd['Len'][1]
@@ -570,12 +989,15 @@ class type_decimal(td_type):
 		
 		o=int(''.join(v for v in [intp,decp,dec_padding]))
 		
-		rph.add_data(td_type=self,data=o)
+		return o
 		
 		
 	def unpack(self,row_data,offset):
 		
 		row_item,new_offset = td_type.unpack(self,row_data,offset)
+		return self.convert(row_item),new_offset
+	
+	def convert(self,row_item):
 		
 		scale = self.fd['Len'][1]
 				
@@ -592,13 +1014,41 @@ class type_decimal(td_type):
 			lhs = str(row_item)[:- scale]
 			rhs = str(row_item)[-scale:]
 			
-			return '{2}{0}.{1}'.format(lhs,string.zfill(rhs,scale),negative),new_offset
+			return '{2}{0}.{1}'.format(lhs,string.zfill(rhs,scale),negative)
 		else:
-			return str(row_item),new_offset
+			return str(row_item)
+	
+	def convert_array(self,values):
+		
+		scale = self.fd['Len'][1]
+		
+		if scale == 0:
+			return [str(v) for v in values.tolist()]
+		
+		values = values.astype('i8')
+		lhs,rhs = numpy.divmod(numpy.absolute(values),10 ** scale)
+		
+		#like convert(), a zero integer part is left empty eg -.05
+		fmt = '%s%s.%0{0}d'.format(scale)
+		
+		return [fmt % (sign,i or '',d) for sign,i,d in
+					zip(numpy.where(values < 0,'-','').tolist(),lhs.tolist(),rhs.tolist())]
 
 class indic_data:
 	"""pack/unpacker for teradata binary indicator data
-	- the nth-bit indicates whether the nth column is null or not"""
+	- the nth-bit indicates whether the nth column is null or not
+	- bytes are converted with 256 entry lookup tables, not bit by bit
+	- the nulls of a row can also be handled as a bitset: an int with bit n
+	  set if the nth column is null"""
+	
+	#byte -> its 8 null flags, most significant bit (lowest column) first
+	byte_bits = [tuple([bool(b & (0x80 >> i)) for i in range(0,8)]) for b in range(0,256)]
+	
+	#8 null flags -> byte
+	bits_byte = dict([(bits,chr(b)) for b,bits in enumerate(byte_bits)])
+	
+	#byte -> byte with its bits reversed, so the lowest column is bit 0
+	reverse_bits = ''.join([chr(int('{0:08b}'.format(b)[::-1],2)) for b in range(0,256)])
 	
 	def __init__(self,column_count):
 		self.column_count= column_count
@@ -607,43 +1057,70 @@ class indic_data:
 			self.indic_data_len = column_count/8
 		else:
 			self.indic_data_len = column_count/8 + 1
+		
+		self.mask = (1 << column_count) - 1
 	
 	def pack(self,nulls):
 		"""returns a byte string in indicdata format"""
 		
-		n = 0
-		bytes = []
+		bits = self.indic_data_len * 8
+		nulls = tuple(nulls[:bits])
 		
-		for i in range(0,self.indic_data_len):
-			
-			byte = 0
-			
-			for octet in range( 0, min(8,len(nulls)-n) ):
-				octet = 7 - octet
-				byte = byte + (nulls[n] << (octet))
-				n += 1
-				
-			bytes.append(byte)
-			
-		return b''.join(chr(b) for b in bytes)
+		if len(nulls) < bits:
+			nulls += (False,) * (bits - len(nulls))
+		
+		table = self.bits_byte
+		
+		return b''.join([table[nulls[i : i + 8]] for i in xrange(0,bits,8)])
 	
 	def unpack(self,indic_data):
 		"""Unpack a byte-string of indicator format data
 		and return an array of boolean values"""
 			
 		assert isinstance(indic_data,type(b''))
+		
+		table = self.byte_bits
 		nulls = []
-			
-		for col in range(0,self.column_count):
-			
-			byte = ord(indic_data[col / 8])
-			bit = 7 - (col % 8)
-			
-			is_null = (byte >> bit) & 1
-			
-			nulls.append(bool(is_null))
+		
+		for byte in bytearray(indic_data[:self.indic_data_len]):
+			nulls.extend(table[byte])
+		
+		del nulls[self.column_count:]
 		
 		return nulls
+	
+	def pack_bitset(self,bitset):
+		"""returns the indicdata byte string of a bitset"""
+		
+		if self.indic_data_len == 0:
+			return b''
+		
+		data = binascii.unhexlify('{0:0{1}x}'.format(bitset & self.mask,self.indic_data_len * 2))
+		
+		return data[::-1].translate(self.reverse_bits)
+	
+	def unpack_bitset(self,indic_data):
+		"""returns the nulls of indicdata byte string indic_data as a bitset"""
+		
+		data = indic_data[:self.indic_data_len].translate(self.reverse_bits)[::-1]
+		
+		if len(data) == 0:
+			return 0
+		
+		return int(binascii.hexlify(data),16) & self.mask
+	
+	def pack_rows(self,bitsets):
+		"""returns the indicdata byte string of each row's bitset"""
+		
+		pack = self.pack_bitset
+		return [pack(bitset) for bitset in bitsets]
+	
+	def unpack_rows(self,rows):
+		"""returns the bitset of each row's indicdata - rows may be whole
+		records, as only the leading indicator bytes are read"""
+		
+		unpack = self.unpack_bitset
+		return [unpack(row) for row in rows]
 
 class row_pack_handler:
 	"""collects the items for a row"""
@@ -742,143 +1219,1663 @@ class row_unpack_handler:
 				raise Exception('End of row overflow')
 			
 		return row_items
-			
-			
-	
-def fexp_to_csv(ddf,fexp_file,args):
-	"""binary safe conversion from binary fast-export format to csv
-	
-	ddf - contains definitions of all fields required for conversion
-	fexp_file - filename of binary fastexp file we read from
-	args - arguments passed by the user (eg verbosity, output file)
-	"""
 
-	if args.use_column_titles is True:
-		header_nm = 'Title'
-	else:
-		header_nm = 'Name'
+class row_decoder:
+	"""decodes indicator format rows using a plan compiled once from the td_types
+	- runs of fixed width columns are unpacked by a single precompiled struct
+	- VARCHAR columns are sliced inline using their 2 byte length
+	- NULL columns are skipped rather than converted"""
 	
-	cols=[]
-	td_types = []
-
-	for fd in ddf:
-
-		cols.append(fd[header_nm])
-		try:
-			#define each td_type with appropriate type_TYPE handler
-			td_types.append(
-				globals()['type_{0}'.format(fd['Type'].lower())](fd)
-			)
-		except KeyError:
-			raise Exception("Unable to find handler class '{0}' for '{1}'".format(
-				fd['Type'],fd['Title']))
+	varchar_len = struct.Struct('=H')
 	
-	with file(args.output,'w') as out_file:
-		out = csv.writer(out_file,quoting=csv.QUOTE_MINIMAL)
+	def __init__(self,td_types,convert=True):
+		"""convert - False to leave DATE/DECIMAL values as their integers"""
 		
-		out.writerow(cols)
+		self.convert = convert
+		self.columns = len(td_types)
+		self.indic = indic_data(self.columns)
+		self.indic_len = self.indic.indic_data_len
+		self.no_nulls = b'\x00' * self.indic_len
 		
-		with open(fexp_file,'rb') as input:
+		#each step is either (struct,[(column,converter),..]) for a run of
+		#fixed width columns or (None,column) for a single VARCHAR column
+		self.steps = []
+		run = []
+		
+		for col,td_type in enumerate(td_types):
 			
-			while True:
-				
-				header = input.read(2)
-				if len(header) < 2:
-					#EOF
-					break
-				
-				row_len = struct.unpack('H',header)[0]
-				row_data = input.read(row_len)
-				
-				ruh = row_unpack_handler(row_data,len(td_types))
-				
-				row_items = ruh.unpack_row(td_types,row_data,row_len) #fexpb.row_unpack(row_data,row_len[0])
-					
-				out.writerow(row_items)
-				input.read(1) #End of record indicator is a single newline char..
-	
-def csv_to_fexp(ddf,csv_file,fexp_file,args):
-	"""binary safe conversion from csv to fast-export binary format
+			if isinstance(td_type,type_varchar):
+				self.add_run(run)
+				run = []
+				self.steps.append((None,col))
+			else:
+				run.append((col,td_type))
+		
+		self.add_run(run)
 	
-	ddf - contains definitions of all fields in the csv (and potential fields not in the csv)
-	csv_file - filename of csv we read from
-	fexp_file - filename of fexp file we write to
-	args - arguments passed by the user (eg verbosity)
+	def add_run(self,run):
+		"""merge consecutive fixed width columns into one step"""
+		
+		if len(run) == 0:
+			return
+		
+		fmt = '=' + ''.join(td_type.data_type for col,td_type in run)
+		fields = []
+		
+		for col,td_type in run:
+			#only keep a converter if the type does more than return the value
+			if td_type.converts is False or self.convert is False:
+				fields.append((col,None))
+			else:
+				fields.append((col,td_type.convert))
+		
+		self.steps.append((struct.Struct(fmt),fields))
 	
+	def decode(self,row_data,row_len):
+		"""returns a list of the csv values of a row, None for NULL columns
+		- row_data is normally a memoryview from raw_reader"""
+		
+		if not isinstance(row_data,memoryview):
+			row_data = memoryview(row_data)
+		
+		if row_data[:self.indic_len] == self.no_nulls:
+			nulls = None
+		else:
+			nulls = self.indic.unpack(row_data[:self.indic_len].tobytes())
+		
+		row_items = [None] * self.columns
+		offset = self.indic_len
+		unpack_len = self.varchar_len.unpack_from
+		
+		for fixed,fields in self.steps:
+			
+			if fixed is None:
+				var_len = unpack_len(row_data,offset)[0]
+				offset += 2
+				if nulls is None or nulls[fields] is False:
+					row_items[fields] = row_data[offset : offset + var_len].tobytes()
+				offset += var_len
+				continue
+			
+			values = fixed.unpack_from(row_data,offset)
+			offset += fixed.size
+			
+			for (col,convert),value in zip(fields,values):
+				if nulls is not None and nulls[col] is True:
+					continue
+				elif convert is None:
+					row_items[col] = value
+				else:
+					row_items[col] = convert(value)
+		
+		if offset > row_len:
+			raise Exception('End of row overflow')
+		
+		return row_items
+			
+
+class block_decoder:
+	"""decodes blocks of fixed length indicator format records with numpy
+	- a block of records is viewed as an array of a structured dtype built
+	  from the td_type formats, without unpacking each row
+	- the indicator bits of the whole block are unpacked at once
+	- each column is converted at once by its td_type's convert_array
 	
-	returns the actual ddfs used
-	"""
+	only usable when there are no VARCHAR columns (see fixed_record_size)"""
 	
+	numpy_types = {'b':'i1','h':'i2','i':'i4','q':'i8','f':'f4','d':'f8'}
 	
-	with open(csv_file,'r') as f:
+	def __init__(self,td_types,block_size=4194304):
 		
-		dict_reader = csv.DictReader(f)
+		self.td_types = td_types
+		self.columns = len(td_types)
+		self.record_size = fixed_record_size(td_types)
+		self.block_records = max(1,block_size / self.record_size)
 		
-		if args.use_column_titles is True:
-			column = 'Title'
-		else:
-			column = 'Name'
+		#length, indicator bytes, each column and the end of record newline
+		fields = [('len','=u2'),('indic','u1',(indic_data(self.columns).indic_data_len,))]
 		
-		#td_types for use
-		td_types=[]
+		for col,td_type in enumerate(td_types):
+			if isinstance(td_type,type_char):
+				fields.append(('c{0}'.format(col),'u1',(td_type.data_length,)))
+			else:
+				fields.append(('c{0}'.format(col),'=' + self.numpy_types[td_type.data_type]))
 		
-		#available field definitions
-		defined_fields = [fd[column] for fd in ddf]
+		fields.append(('eor','u1'))
 		
-		#compare available_fields with the headers from the csv file being read
-		for field in dict_reader.fieldnames:
-			if field not in defined_fields:
-				raise Exception("'{0}' not defined in '{1}' - unable to continue".format(
-					field,args.dest))
-			else:
-				for fd in ddf:
-					if fd[column] == field:
-						try:
-							#define each td_type with appropriate type_TYPE handler
-							td_types.append(
-								globals()['type_{0}'.format(fd['Type'].lower())](fd)
-								)
-						except KeyError:
-							raise Exception("Unable to find handler class '{0}' for '{1}'".format(
-								fd['Type'],fd['Title']))
-								
-						
-		with open(fexp_file,'wb') as out:
+		self.dtype = numpy.dtype(fields)
+		assert self.dtype.itemsize == self.record_size
+	
+	def records(self,block):
+		"""returns a block of whole records as an array of self.dtype"""
 		
-			for row in dict_reader:
-				
-				if len(row) < len(td_types):
-					raise Exception('Row is missing columns')
-					
-				elif len(row) > len(td_types):
-					raise Exception('Row has too many columns')
-					
-				rph = row_pack_handler()
+		records = numpy.frombuffer(block,dtype=self.dtype)
+		
+		if (records['len'] != self.record_size - 3).any():
+			raise Exception('Record length does not match the column definitions')
+		
+		return records
+	
+	def nulls(self,records):
+		"""returns a (rows,columns) boolean array, True for NULL columns"""
+		return numpy.unpackbits(records['indic'],axis=1)[:,:self.columns] == 1
+	
+	def decode_block(self,block):
+		"""returns the rows of a block of whole records as lists of csv
+		values, None for NULL columns"""
+		
+		records = self.records(block)
+		rows = numpy.empty((len(records),self.columns),dtype=object)
+		
+		for col,td_type in enumerate(self.td_types):
+			rows[:,col] = td_type.convert_array(records['c{0}'.format(col)])
+		
+		rows[self.nulls(records)] = None
+		
+		return rows.tolist()
+	
+	def write_csv_rows(self,input,out,start=0,end=None):
+		"""decodes the records of file object input between byte offsets
+		start and end and writes them to csv writer out
+		
+		returns the number of rows written"""
+		
+		rows = 0
+		
+		for block in self.blocks(input,start,end):
+			decoded = self.decode_block(block)
+			out.writerows(decoded)
+			rows += len(decoded)
+		
+		return rows
+	
+	def blocks(self,input,start=0,end=None):
+		"""yields blocks of up to block_records whole records read from
+		file object input between byte offsets start and end"""
+		
+		if start > 0:
+			input.seek(start)
+		
+		if end is None:
+			remaining = None
+		else:
+			remaining = end - start
+		
+		block_len = self.block_records * self.record_size
+		
+		while True:
+			
+			read_len = block_len
+			if remaining is not None:
+				read_len = min(read_len,remaining)
+			
+			if read_len > 0:
+				block = input.read(read_len)
+			else:
+				block = b''
+			
+			if remaining is not None:
+				remaining -= len(block)
+			
+			partial = len(block) % self.record_size
+			
+			if partial == self.record_size - 1:
+				#the last record may be missing its newline
+				block += '\n'
+			elif partial > 0:
+				raise Exception('Truncated record at end of binary file')
+			
+			if len(block) == 0:
+				return
+			
+			yield block
+
+class raw_reader:
+	"""iterates over the records of a binary indicdata/fastload file
+	- the file is read in large blocks rather than three reads per record
+	- each record body is returned as a zero-copy memoryview of its block
+	- records spanning two blocks are carried over into the next block
+	
+	input - file object opened in binary mode (may be a pipe)"""
+	
+	record_len = struct.Struct('=H')
+	
+	def __init__(self,input,block_size=4194304,start=0,end=None):
+		"""start/end limit the reader to a record aligned byte range"""
+		self.input = input
+		self.block_size = block_size
+		self.start = start
+		self.end = end
+		
+	def __iter__(self):
+		
+		unpack_len = self.record_len.unpack_from
+		block = b''
+		view = memoryview(block)
+		pos = 0
+		eof = False
+		
+		if self.start > 0:
+			self.input.seek(self.start)
+		
+		if self.end is None:
+			remaining = None
+		else:
+			remaining = self.end - self.start
+		
+		while True:
+			
+			available = len(block) - pos
+			
+			if available < 2:
+				row_len = None
+				need = 2
+			else:
+				row_len = unpack_len(block,pos)[0]
+				#length, body and the end of record newline
+				need = row_len + 3
+			
+			if available < need and eof is False:
+				#carry the partial record over to the start of the next block
+				read_len = max(self.block_size,need)
+				if remaining is not None:
+					read_len = min(read_len,remaining)
 				
-				for td_type in td_types:
-					
-					r = row[td_type.fd[column]]
+				if read_len > 0:
+					data = self.input.read(read_len)
+				else:
+					data = b''
+				
+				if len(data) == 0:
+					eof = True
+				elif remaining is not None:
+					remaining -= len(data)
+				block = block[pos:] + data
+				view = memoryview(block)
+				pos = 0
+				continue
+			
+			if row_len is None or available < need - 1:
+				if available > 0:
+					raise Exception('Truncated record at end of binary file')
+				#EOF
+				return
+			
+			#the last record may be missing its newline
+			yield view[pos + 2 : pos + 2 + row_len]
+			pos += need
+
+def split_raw_file(fexp_file,parts,record_size=None,block_size=4194304):
+	"""splits a binary indicdata/fastload file into record aligned
+	byte ranges of roughly equal size
+	
+	record_size - if every record has the same length the boundaries are
+				  calculated rather than scanned for
+	
+	returns a list of (start,end) tuples"""
+	
+	size = os.path.getsize(fexp_file)
+	bounds = [0]
+	
+	if record_size is not None:
+		records = size / record_size
+		for i in range(1,parts):
+			bounds.append(records * i / parts * record_size)
+	else:
+		targets = [size * i / parts for i in range(1,parts)]
+		unpack_len = raw_reader.record_len.unpack_from
+		
+		with open(fexp_file,'rb') as input:
+			
+			block = b''
+			block_start = pos = 0
+			
+			#hop from length prefix to length prefix until each target is passed
+			while len(targets) > 0 and pos < size:
+				
+				if pos + 2 > block_start + len(block):
+					input.seek(pos)
+					block_start = pos
+					block = input.read(block_size)
+					if len(block) < 2:
+						break
+				
+				if pos >= targets[0]:
+					bounds.append(pos)
+					targets.pop(0)
+					continue
+				
+				pos += unpack_len(block,pos - block_start)[0] + 3
+	
+	bounds.append(size)
+	
+	return [(bounds[i],bounds[i+1]) for i in range(0,len(bounds)-1)
+				if bounds[i] < bounds[i+1]]
+
+def shard_raw_file(fexp_file,shards,record_size=None):
+	"""copies the record aligned ranges of split_raw_file into separate
+	files, so that each can be imported by its own utility process
+	
+	returns the shard filenames, in order"""
+	
+	shard_files = []
+	
+	try:
+		with open(fexp_file,'rb') as input:
+			for i,(start,end) in enumerate(split_raw_file(fexp_file,shards,record_size)):
+				
+				shard_file = '{0}.shard{1}'.format(fexp_file,i)
+				shard_files.append(shard_file)
+				input.seek(start)
+				
+				with open(shard_file,'wb') as out:
+					remaining = end - start
+					while remaining > 0:
+						block = input.read(min(remaining,4194304))
+						if len(block) == 0:
+							raise Exception("'{0}' is truncated".format(fexp_file))
+						out.write(block)
+						remaining -= len(block)
+	except:
+		for shard_file in shard_files:
+			if os.path.exists(shard_file):
+				os.remove(shard_file)
+		raise
+	
+	return shard_files
+
+def print_cache_stats(td_types):
+	"""prints the hit rate of each column's conversion caches"""
+	
+	for td_type in td_types:
+		for name,hits,misses in td_type.cache_stats():
+			if hits + misses > 0:
+				print '--- {0} {1} cache: {2} hits, {3} misses ({4:.1%})'.format(
+					td_type.fd['Name'],name,hits,misses,float(hits) / (hits + misses))
+
+def get_td_types(ddf):
+	"""returns the td_type handler for each field definition in ddf"""
+	
+	td_types = []
+	
+	for fd in ddf:
+		try:
+			#define each td_type with appropriate type_TYPE handler
+			td_types.append(
+				globals()['type_{0}'.format(fd['Type'].lower())](fd)
+			)
+		except KeyError:
+			raise Exception("Unable to find handler class '{0}' for '{1}'".format(
+				fd['Type'],fd['Title']))
+	
+	return td_types
+
+def fixed_record_size(td_types):
+	"""returns the length of every record in a binary file, including the
+	record length and newline, or None if there are VARCHAR columns"""
+	
+	if len([t for t in td_types if isinstance(t,type_varchar)]) > 0:
+		return None
+	
+	return 3 + indic_data(len(td_types)).indic_data_len + sum(t.data_length for t in td_types)
+
+def write_raw_csv_rows(td_types,input,out,start=0,end=None):
+	"""decodes the records of binary file object input between byte offsets
+	start and end and writes them to csv writer out - a block at a time with
+	numpy if every record has the same length, otherwise row by row
+	
+	returns the number of rows written"""
+	
+	if load_numpy() is not None and fixed_record_size(td_types) is not None:
+		return block_decoder(td_types).write_csv_rows(input,out,start,end)
+	
+	return write_csv_rows(row_decoder(td_types),raw_reader(input,start=start,end=end),out)
+
+def raw_range_to_csv(task):
+	"""converts one byte range of a binary file to csv rows, headed by
+	header unless it is None
+	- runs in a worker process so takes a single picklable tuple"""
+	
+	ddf,fexp_file,start,end,csv_file,header = task
+	
+	with file(csv_file,'w') as out_file:
+		out = csv.writer(out_file,quoting=csv.QUOTE_MINIMAL)
+		
+		if header is not None:
+			out.writerow(header)
+		
+		with open(fexp_file,'rb') as input:
+			return write_raw_csv_rows(get_td_types(ddf),input,out,start,end)
+
+def fexp_to_csv_parallel(ddf,fexp_file,out_file,workers):
+	"""converts fexp_file using a pool of worker processes, each decoding
+	a record aligned range into a part file which is appended to out_file
+	in order
+	
+	returns the number of rows written"""
+	
+	record_size = fixed_record_size(get_td_types(ddf))
+	
+	ranges = split_raw_file(fexp_file,workers,record_size)
+	
+	tasks = []
+	for i,(start,end) in enumerate(ranges):
+		tasks.append((ddf,fexp_file,start,end,'{0}.part{1}'.format(out_file.name,i),None))
+	
+	import multiprocessing
+	
+	pool = multiprocessing.Pool(min(workers,max(len(tasks),1)))
+	rows = 0
+	
+	try:
+		#imap returns in order, so parts are appended as soon as they are ready
+		for task,part_rows in zip(tasks,pool.imap(raw_range_to_csv,tasks)):
+			with open(task[4],'rb') as part:
+				shutil.copyfileobj(part,out_file)
+			os.remove(task[4])
+			rows += part_rows
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		for task in tasks:
+			if os.path.exists(task[4]):
+				os.remove(task[4])
+	
+	return rows
+
+def fexp_to_csv(ddf,fexp_file,args):
+	"""binary safe conversion from binary fast-export format to csv
+	
+	ddf - contains definitions of all fields required for conversion
+	fexp_file - filename of binary fastexp file we read from
+	args - arguments passed by the user (eg verbosity, output file)
+	
+	returns the number of rows written
+	"""
+
+	if args.use_column_titles is True:
+		header_nm = 'Title'
+	else:
+		header_nm = 'Name'
+	
+	cols = [fd[header_nm] for fd in ddf]
+	
+	with file(args.output,'w') as out_file:
+		out = csv.writer(out_file,quoting=csv.QUOTE_MINIMAL)
+		
+		out.writerow(cols)
+		
+		if getattr(args,'workers',1) > 1:
+			out_file.flush()
+			return fexp_to_csv_parallel(ddf,fexp_file,out_file,args.workers)
+		
+		td_types = get_td_types(ddf)
+		
+		with open(fexp_file,'rb') as input:
+			rows = write_raw_csv_rows(td_types,input,out)
+		
+		if args.verbose is True:
+			print_cache_stats(td_types)
+	
+	return rows
+
+def csv_part_file(csv_file,part):
+	"""names part N of csv_file, eg out.csv -> out.part0.csv"""
+	
+	root,ext = os.path.splitext(csv_file)
+	return '{0}.part{1}{2}'.format(root,part,ext)
+
+def fexp_parts_to_csv(ddf,fexp_files,args,workers,keep_parts=False):
+	"""converts binary files with the same layout in a pool of worker
+	processes, each as soon as it is available, and appends them to
+	args.output in order - with keep_parts each is left as its own csv file
+	(with a header) instead
+	
+	fexp_files - iterable of filenames, each removed once converted
+	
+	returns the number of rows written"""
+	
+	if args.use_column_titles is True:
+		header_nm = 'Title'
+	else:
+		header_nm = 'Name'
+	
+	cols = [fd[header_nm] for fd in ddf]
+	
+	import multiprocessing
+	
+	pool = multiprocessing.Pool(workers)
+	tasks = []
+	rows = 0
+	
+	try:
+		for i,fexp_file in enumerate(fexp_files):
+			if keep_parts is True:
+				task = (ddf,fexp_file,0,None,csv_part_file(args.output,i),cols)
+			else:
+				task = (ddf,fexp_file,0,None,'{0}.part{1}'.format(args.output,i),None)
+			tasks.append((task,pool.apply_async(raw_range_to_csv,[task])))
+		
+		for task,result in tasks:
+			rows += result.get()
+			os.remove(task[1])
+		
+		pool.close()
+	except:
+		pool.terminate()
+		for task,result in tasks:
+			if os.path.exists(task[4]):
+				os.remove(task[4])
+		raise
+	finally:
+		pool.join()
+	
+	if keep_parts is False:
+		with file(args.output,'w') as out_file:
+			csv.writer(out_file,quoting=csv.QUOTE_MINIMAL).writerow(cols)
+			
+			for task,result in tasks:
+				with open(task[4],'rb') as part:
+					shutil.copyfileobj(part,out_file)
+				os.remove(task[4])
+	
+	return rows
+
+def column_dtype(td_type):
+	"""returns the numpy dtype holding the unpacked values of td_type"""
+	
+	if isinstance(td_type,type_char):
+		return numpy.dtype('S{0}'.format(td_type.data_length))
+	
+	return numpy.dtype('=' + block_decoder.numpy_types[td_type.data_type])
+
+def raw_batches(td_types,input,batch_rows=65536):
+	"""yields the records of binary file object input in batches of up to
+	batch_rows rows, as a (columns,nulls) tuple
+	
+	columns - the unpacked values of each column: a numpy array, or a list
+			  of strings (None if NULL) for VARCHAR columns - DATE and DECIMAL
+			  values are left as their integers
+	nulls - a (rows,columns) boolean numpy array, True for NULL columns"""
+	
+	record_size = fixed_record_size(td_types)
+	
+	if record_size is not None:
+		decoder = block_decoder(td_types,batch_rows * record_size)
+		
+		for block in decoder.blocks(input):
+			records = decoder.records(block)
+			columns = []
+			
+			for col,td_type in enumerate(td_types):
+				values = records['c{0}'.format(col)]
+				if isinstance(td_type,type_char):
+					values = numpy.ascontiguousarray(values).view(column_dtype(td_type)).ravel()
+				columns.append(values)
+			
+			yield columns,decoder.nulls(records)
+		
+		return
+	
+	decoder = row_decoder(td_types,convert=False)
+	rows = []
+	
+	for record in raw_reader(input):
+		rows.append(decoder.decode(record,len(record)))
+		
+		if len(rows) == batch_rows:
+			yield row_batch(td_types,rows)
+			rows = []
+	
+	if len(rows) > 0:
+		yield row_batch(td_types,rows)
+
+def row_batch(td_types,rows):
+	"""returns the (columns,nulls) batch of a list of row_decoder rows"""
+	
+	nulls = numpy.array([[v is None for v in row] for row in rows],dtype=bool)
+	columns = []
+	
+	for td_type,values in zip(td_types,zip(*rows)):
+		
+		if isinstance(td_type,type_varchar):
+			columns.append(list(values))
+			continue
+		
+		if isinstance(td_type,type_char):
+			empty = ''
+		else:
+			empty = 0
+		
+		columns.append(numpy.array([empty if v is None else v for v in values],dtype=column_dtype(td_type)))
+	
+	return columns,nulls
+
+class npy_column:
+	"""appends arrays to a .npy file, writing the shape into its header
+	once the number of rows is known"""
+	
+	header_len = 128
+	
+	def __init__(self,filename,dtype):
+		self.f = open(filename,'wb')
+		self.dtype = numpy.dtype(dtype)
+		self.rows = 0
+		self.write_header()
+	
+	def write_header(self):
+		
+		header = "{{'descr': {0!r}, 'fortran_order': False, 'shape': ({1},), }}".format(
+					numpy.lib.format.dtype_to_descr(self.dtype),self.rows)
+		
+		#version 1.0 - magic, version, header length then the padded header
+		self.f.write(numpy.lib.format.MAGIC_PREFIX + '\x01\x00' + struct.pack('<H',self.header_len - 10)
+					+ header.ljust(self.header_len - 11) + '\n')
+	
+	def write(self,values):
+		self.f.write(numpy.ascontiguousarray(values,dtype=self.dtype).tobytes())
+		self.rows += len(values)
+	
+	def close(self):
+		self.f.seek(0)
+		self.write_header()
+		self.f.close()
+
+class npy_writer:
+	"""writes each column to its own .npy file in directory output
+	- INTEGER/SMALLINT/BYTEINT/FLOAT columns keep their binary type
+	- DATE columns are datetime64[D], DECIMAL columns their scaled integers
+	- CHAR columns are fixed width byte strings, VARCHAR columns a uint8 array
+	  of their concatenated bytes and an .offsets.npy array of n+1 offsets
+	- nullable columns also get a boolean .nulls.npy array
+	- columns.json lists the files, types and decimal scales"""
+	
+	def __init__(self,td_types,names,output):
+		
+		os.mkdir(output)
+		
+		self.td_types = td_types
+		self.files = []
+		columns = []
+		
+		for col,(td_type,name) in enumerate(zip(td_types,names)):
+			
+			#prefixed with the column number, as names may not be unique
+			prefix = os.path.join(output,'{0:03}_{1}'.format(col,re.sub('[^A-Za-z0-9_]','_',name)))
+			fd = td_type.fd
+			
+			column = {'name':name,'type':fd['Type'],'file':os.path.basename(prefix) + '.npy'}
+			files = {}
+			
+			if isinstance(td_type,type_varchar):
+				files['data'] = npy_column(prefix + '.npy','u1')
+				files['offsets'] = npy_column(prefix + '.offsets.npy','i8')
+				files['offsets'].write(numpy.zeros(1,dtype='i8'))
+				column['offsets'] = os.path.basename(prefix) + '.offsets.npy'
+			else:
+				files['data'] = npy_column(prefix + '.npy',td_type.typed_array(
+									numpy.zeros(0,dtype=column_dtype(td_type))).dtype)
+			
+			if fd['Nulls'] is True:
+				files['nulls'] = npy_column(prefix + '.nulls.npy',bool)
+				column['nulls'] = os.path.basename(prefix) + '.nulls.npy'
+			
+			if fd['Type'] == 'DECIMAL':
+				column['precision'],column['scale'] = fd['Len']
+			
+			self.files.append(files)
+			columns.append(column)
+		
+		with open(os.path.join(output,'columns.json'),'w') as f:
+			json.dump(columns,f,indent=1)
+	
+	def write_batch(self,columns,nulls):
+		
+		for col,(td_type,values,files) in enumerate(zip(self.td_types,columns,self.files)):
+			
+			if isinstance(td_type,type_varchar):
+				values = [v or '' for v in values]
+				#offsets carry on from the bytes already written
+				offsets = numpy.cumsum([len(v) for v in values],dtype='i8') + files['data'].rows
+				files['data'].write(numpy.frombuffer(''.join(values),dtype='u1'))
+				files['offsets'].write(offsets)
+			else:
+				files['data'].write(td_type.typed_array(values))
+			
+			if 'nulls' in files:
+				files['nulls'].write(nulls[:,col])
+	
+	def close(self):
+		for files in self.files:
+			for f in files.values():
+				f.close()
+
+class arrow_writer:
+	"""writes record batches to an Arrow IPC file (requires pyarrow)
+	- INTEGER/SMALLINT/BYTEINT/FLOAT columns keep their binary type
+	- DATE columns are date32, CHAR/VARCHAR columns binary
+	- DECIMAL columns are their scaled integers, with the precision and
+	  scale kept in the field metadata"""
+	
+	def __init__(self,td_types,names,output):
+		
+		try:
+			import pyarrow
+		except ImportError:
+			raise Exception('Arrow output requires pyarrow')
+		
+		self.pa = pyarrow
+		self.td_types = td_types
+		
+		types = {'BYTEINT':pyarrow.int8(),'SMALLINT':pyarrow.int16(),'INTEGER':pyarrow.int32(),
+				 'FLOAT':pyarrow.float64(),'DATE':pyarrow.date32(),
+				 'CHAR':pyarrow.binary(),'VARCHAR':pyarrow.binary()}
+		decimals = {'b':pyarrow.int8(),'h':pyarrow.int16(),'i':pyarrow.int32(),'q':pyarrow.int64()}
+		
+		fields = []
+		
+		for td_type,name in zip(td_types,names):
+			fd = td_type.fd
+			
+			if fd['Type'] == 'DECIMAL':
+				fields.append(pyarrow.field(name,decimals[td_type.data_type],fd['Nulls'],
+								{'precision':str(fd['Len'][0]),'scale':str(fd['Len'][1])}))
+			else:
+				fields.append(pyarrow.field(name,types[fd['Type']],fd['Nulls']))
+		
+		self.schema = pyarrow.schema(fields)
+		self.sink = pyarrow.OSFile(output,'wb')
+		self.writer = pyarrow.RecordBatchFileWriter(self.sink,self.schema)
+	
+	def write_batch(self,columns,nulls):
+		
+		arrays = []
+		
+		for col,(td_type,values,field) in enumerate(zip(self.td_types,columns,self.schema)):
+			
+			if isinstance(td_type,type_varchar):
+				#None values are already nulls
+				arrays.append(self.pa.array(values,type=field.type))
+				continue
+			
+			mask = nulls[:,col]
+			if not mask.any():
+				mask = None
+			
+			arrays.append(self.pa.array(td_type.typed_array(values),type=field.type,mask=mask))
+		
+		self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays,schema=self.schema))
+	
+	def close(self):
+		self.writer.close()
+		self.sink.close()
+
+def fexp_to_columns(ddf,fexp_file,args):
+	"""converts a binary fast-export file to columnar output - a directory of
+	.npy files or an Arrow IPC file (args.format 'npy' or 'arrow')
+	
+	rows are decoded and written in batches of args.batch_rows, so memory use
+	doesn't grow with the size of the export
+	
+	returns the number of rows written"""
+	
+	if load_numpy() is None:
+		raise Exception('--format {0} requires numpy'.format(args.format))
+	
+	if args.use_column_titles is True:
+		header_nm = 'Title'
+	else:
+		header_nm = 'Name'
+	
+	td_types = get_td_types(ddf)
+	names = [fd[header_nm] for fd in ddf]
+	
+	writer = {'npy':npy_writer,'arrow':arrow_writer}[args.format](td_types,names,args.output)
+	rows = 0
+	
+	try:
+		with open(fexp_file,'rb') as input:
+			for columns,nulls in raw_batches(td_types,input,args.batch_rows):
+				writer.write_batch(columns,nulls)
+				rows += len(nulls)
+	finally:
+		writer.close()
+	
+	return rows
+
+def write_csv_rows(decoder,records,out):
+	"""decodes each record body from records and writes it to csv writer out
+	
+	returns the number of rows written"""
+	
+	rows = 0
+	
+	for row_data in records:
+		out.writerow(decoder.decode(row_data,len(row_data)))
+		rows += 1
+	
+	return rows
+
+def direct_to_csv(sql,dbc,uid,pw,args):
+	"""downloads the result of sql straight into a csv file over a single
+	cliv2 session, without a bteq/fexp process or a binary file
+	
+	returns the ddf of the query and the number of rows fetched"""
+	
+	if args.use_column_titles is True:
+		header_nm = 'Title'
+	else:
+		header_nm = 'Name'
+	
+	if args.verbose:
+		print '--- logon'
+	
+	dbcc = open_session(dbc,uid,pw,args)
+	
+	try:
+		ddf = get_ddf(sql,dbc,uid,pw,args,dbcc)
+		decoder = row_decoder(get_td_types(ddf['ddf']))
+		
+		with file(args.output,'w') as out_file:
+			out = csv.writer(out_file,quoting=csv.QUOTE_MINIMAL)
+			out.writerow([fd[header_nm] for fd in ddf['ddf']])
+			
+			rows = write_csv_rows(decoder,dbcc.fetch_records(sql),out)
+	finally:
+		if args.verbose:
+			print '--- logout'
+		dbcc.logout()
+	
+	return ddf,rows
+	
+def csv_td_types(ddf,fieldnames,column,dest):
+	"""returns the td_types for the csv header fieldnames, matched against
+	the ddf using column ('Name' or 'Title')"""
+	
+	#td_types for use
+	td_types=[]
+	
+	#available field definitions
+	defined_fields = [fd[column] for fd in ddf]
+	
+	#compare available_fields with the headers from the csv file being read
+	for field in fieldnames:
+		if field not in defined_fields:
+			raise Exception("'{0}' not defined in '{1}' - unable to continue".format(
+				field,dest))
+		else:
+			td_types.extend(get_td_types([fd for fd in ddf if fd[column] == field]))
+	
+	return td_types
+
+class row_encoder:
+	"""encodes csv rows into indicator format records
+	- csv values are read by position, rather than through a dict per row
+	- each record is packed with pack_into and slice assignment straight into
+	  a preallocated batch buffer, which is written out once it holds
+	  batch_size bytes"""
+	
+	record_len = struct.Struct('=H')
+	
+	def __init__(self,td_types,batch_size=1048576):
+		
+		self.td_types = td_types
+		self.columns = len(td_types)
+		self.indic = indic_data(self.columns)
+		self.batch_size = batch_size
+		
+		#(td_type,struct or None for VARCHAR,True for CHAR/VARCHAR,null bit)
+		#for each column
+		self.fields = []
+		record_max = 3 + self.indic.indic_data_len
+		
+		for col,td_type in enumerate(td_types):
+			
+			if isinstance(td_type,type_varchar):
+				packer = None
+				record_max += 2 + td_type.fd['Len']
+			else:
+				packer = struct.Struct('=' + td_type.data_type)
+				record_max += packer.size
+			
+			self.fields.append((td_type,packer,td_type.fd['Type'] in ['CHAR','VARCHAR'],1 << col))
+		
+		self.batch = bytearray(batch_size + record_max)
+	
+	def encode_rows(self,reader,out,line_offset=0):
+		"""encodes the rows read by csv reader and writes them to out
+		
+		line_offset - csv lines preceding the first line read by reader,
+					  so errors report the line number in the original file
+		
+		returns the number of rows encoded"""
+		
+		rows = pos = 0
+		
+		for row in reader:
+			
+			#like csv.DictReader, skip blank lines
+			if len(row) == 0:
+				continue
+			
+			line = line_offset + reader.line_num
+			
+			if len(row) > self.columns:
+				raise Exception('Row has too many columns (line {0})'.format(line))
+			
+			try:
+				pos = self.encode(row,pos)
+			except (ValueError,AttributeError,OverflowError,struct.error) as e:
+				raise e.__class__('{0} (line {1})'.format(e,line))
+			
+			rows += 1
+			
+			if pos >= self.batch_size:
+				out.write(buffer(self.batch,0,pos))
+				pos = 0
+		
+		if pos > 0:
+			out.write(buffer(self.batch,0,pos))
+		
+		return rows
+	
+	def encode(self,row,start):
+		"""packs row into the batch buffer at start
+		
+		returns the offset following the record"""
+		
+		batch = self.batch
+		pack_len = self.record_len.pack_into
+		indic_len = self.indic.indic_data_len
+		
+		offset = start + 2 + indic_len
+		nulls = 0
+		
+		#missing values at the end of a row are empty, as with csv.DictReader
+		if len(row) < self.columns:
+			row = row + [''] * (self.columns - len(row))
+		
+		for (td_type,packer,string,bit),r in zip(self.fields,row):
+			
+			#empty CHAR/VARCHAR values are empty strings, anything else is NULL
+			if len(r) == 0 and string is False:
+				if td_type.fd['Nulls'] is False:
+					raise ValueError('{0} has an empty value, but is defined as NON NULL'.format(
+						td_type.fd['Name']))
+				
+				packer.pack_into(batch,offset,0)
+				offset += packer.size
+				nulls |= bit
+				continue
+			
+			if packer is None:
+				r = td_type.encode(r)
+				pack_len(batch,offset,len(r))
+				offset += 2
+				batch[offset : offset + len(r)] = r
+				offset += len(r)
+			else:
+				packer.pack_into(batch,offset,td_type.encode(r))
+				offset += packer.size
+		
+		row_len = offset - start - 2
+		
+		if row_len > 65534:
+			raise OverflowError('Maximum parcel length is 65k')
+		
+		pack_len(batch,start,row_len)
+		batch[start + 2 : start + 2 + indic_len] = self.indic.pack_bitset(nulls)
+		batch[offset] = '\n'
+		
+		return offset + 1
+
+def encode_csv_rows(td_types,reader,out,line_offset=0,batch_size=1048576):
+	"""encodes the rows read by csv reader and writes them to out, in
+	writes of about batch_size bytes (see row_encoder)
+	
+	returns the number of rows encoded"""
+	
+	return row_encoder(td_types,batch_size).encode_rows(reader,out,line_offset)
+
+def split_csv_file(csv_file,parts):
+	"""splits a csv file into byte ranges of whole rows
+	- a newline only ends a row when an even number of quote characters
+	  have been seen, otherwise it is inside a quoted field
+	
+	returns a list of (start,end,lines_before) tuples covering the rows
+	after the header, lines_before being the csv lines preceding start"""
+	
+	size = os.path.getsize(csv_file)
+	targets = [size * i / parts for i in range(1,parts)]
+	bounds = []
+	quotes = lines = pos = 0
+	
+	with open(csv_file,'rb') as f:
+		
+		while len(bounds) == 0 or len(targets) > 0:
+			
+			line = f.readline()
+			if len(line) == 0:
+				break
+			
+			pos += len(line)
+			lines += 1
+			quotes += line.count('"')
+			
+			if quotes % 2 == 1:
+				continue
+			
+			#the first boundary is the end of the header
+			if len(bounds) == 0 or pos >= targets[0]:
+				bounds.append((pos,lines))
+				while len(targets) > 0 and pos >= targets[0]:
+					targets.pop(0)
+	
+	bounds.append((size,None))
+	
+	return [(bounds[i][0],bounds[i+1][0],bounds[i][1]) for i in range(0,len(bounds)-1)
+				if bounds[i][0] < bounds[i+1][0]]
+
+def read_csv_range(f,start,end):
+	"""yields the lines of the open file f between byte offsets start and end"""
+	
+	f.seek(start)
+	pos = start
+	
+	while pos < end:
+		line = f.readline()
+		if len(line) == 0:
+			break
+		pos += len(line)
+		yield line
+
+def csv_range_to_fexp(task):
+	"""encodes one byte range of a csv file to a binary part file
+	- runs in a worker process so takes a single picklable tuple"""
+	
+	ddf,csv_file,fieldnames,column,dest,start,end,lines_before,fexp_file = task
+	
+	td_types = csv_td_types(ddf,fieldnames,column,dest)
+	
+	with open(csv_file,'rb') as f:
+		reader = csv.reader(read_csv_range(f,start,end))
+		
+		with open(fexp_file,'wb') as out:
+			return encode_csv_rows(td_types,reader,out,lines_before)
+
+def csv_to_fexp_parts(ddf,csv_file,fexp_file,fieldnames,column,dest,workers):
+	"""encodes csv_file with a pool of worker processes, each one writing
+	a range of rows to its own binary part file
+	
+	returns the part filenames in row order"""
+	
+	tasks = []
+	
+	for i,(start,end,lines_before) in enumerate(split_csv_file(csv_file,workers)):
+		tasks.append((ddf,csv_file,fieldnames,column,dest,start,end,lines_before,
+					'{0}.part{1}'.format(fexp_file,i)))
+	
+	import multiprocessing
+	
+	pool = multiprocessing.Pool(min(workers,max(len(tasks),1)))
+	
+	try:
+		pool.map(csv_range_to_fexp,tasks)
+		pool.close()
+	except:
+		pool.terminate()
+		for task in tasks:
+			if os.path.exists(task[-1]):
+				os.remove(task[-1])
+		raise
+	finally:
+		pool.join()
+	
+	return [task[-1] for task in tasks]
+
+class using_insert_batcher:
+	"""collects encoded records into multi-row USING ... INSERT requests
+	- write() takes records as they would be written to a .fexp file
+	- each request carries up to max_rows rows and max_data bytes of data,
+	  with one indicator bitmap covering the fields of every row
+	
+	submit - called with (request text,using data,row count) for each request"""
+	
+	max_data = 64000
+	max_fields = 2550			#limit on USING variables in a request
+	
+	def __init__(self,tbl,fields,submit,max_rows):
+		
+		self.tbl = tbl
+		self.fields = fields
+		self.submit = submit
+		self.columns = len(fields)
+		self.max_rows = max(1,min(max_rows,self.max_fields / self.columns))
+		self.indic = indic_data(self.columns)
+		
+		#request text for each row count
+		self.requests = {}
+		
+		(self.nulls,self.data,self.data_len) = (0,[],0)
+		
+	def request_text(self,rows):
+		
+		if rows not in self.requests:
+			
+			using = ','.join('c{0}_{1} {2}'.format(c,r,f['Types'])
+						for r in range(0,rows) for c,f in enumerate(self.fields))
+			
+			insert = 'INSERT INTO {0} ({1}) VALUES ({{0}});'.format(self.tbl,
+						','.join(f['Name'] for f in self.fields))
+			
+			self.requests[rows] = 'USING ({0}) {1}'.format(using,''.join(insert.format(
+						','.join(':c{0}_{1}'.format(c,r) for c in range(0,self.columns)))
+							for r in range(0,rows)))
+		
+		return self.requests[rows]
+	
+	def write(self,record):
+		
+		indic_len = self.indic.indic_data_len
+		
+		#strip the length, indicator bytes and newline
+		data = record[2 + indic_len : -1]
+		rows = len(self.data) + 1
+		
+		if rows > self.max_rows or self.data_len + len(data) + \
+				indic_data(rows * self.columns).indic_data_len > self.max_data:
+			self.flush()
+		
+		#the nulls of every row in one bitset, row after row
+		self.nulls |= self.indic.unpack_bitset(record[2 : 2 + indic_len]) << (len(self.data) * self.columns)
+		self.data.append(data)
+		self.data_len += len(data)
+		
+	def flush(self):
+		
+		rows = len(self.data)
+		
+		if rows == 0:
+			return
+		
+		using_data = indic_data(rows * self.columns).pack_bitset(self.nulls) + ''.join(self.data)
+		self.submit(self.request_text(rows),using_data,rows)
+		
+		(self.nulls,self.data,self.data_len) = (0,[],0)
+
+class insert_session(threading.Thread):
+	"""a cliv2 session executing the requests put on a shared queue
+	until it gets None"""
+	
+	def __init__(self,requests,results,logon):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.requests = requests
+		self.results = results
+		self.logon = logon
+		self.error = None
+		
+	def run(self):
+		
+		try:
+			with tdmetrics.stage('logon'):
+				dbcc = dbc_connection()
+				dbcc.logon(*self.logon)
+			
+			try:
+				while True:
+					request = self.requests.get()
+					if request is None:
+						break
 					
-					if r is None or len(r) == 0:
-						if td_type.fd['Type'] in ['CHAR','VARCHAR']:
-							
-							r=''
-							rph.define_null(False)
-						else:
-							if td_type.fd['Nulls'] is False:
-								raise ValueError('{0} has an empty value, but is defined as NON NULL'.format(
-									td_type.fd['Name']))
-							
-							rph.add_data(td_type=td_type,data=0)
-							rph.define_null(True)
-							continue
-						
-					else:
-						rph.define_null(False)
-						
-					#depending on the type, this calls type_TYPE.pack()
-					rph.pack(td_type=td_type,data=r)
+					sql,using_data,rows = request
+					counts = dbcc.execute_using(sql,using_data)
+					self.results.append({'rows':rows,'inserted':sum(counts)})
+			finally:
+				dbcc.logout()
+				
+		except Exception as e:
+			self.error = e
+
+def direct_insert(tbl,fields,ddf,csv_file,dbc,uid,pw,args):
+	"""inserts the rows of csv_file into tbl with multi-row USING requests
+	sent over args.sessions cliv2 sessions, without a bteq process
+	
+	fields - the csv field definitions, including the 'Types' sql type
+	
+	returns a list of dicts, one per request, with the rows sent and inserted"""
+	
+	if args.use_column_titles is True:
+		column = 'Title'
+	else:
+		column = 'Name'
+	
+	requests = Queue.Queue(args.sessions * 2)
+	results = []
+	sessions = []
+	
+	for i in range(0,args.sessions):
+		sessions.append(insert_session(requests,results,(dbc,uid,pw)))
+		sessions[-1].start()
+	
+	def put(request):
+		#don't block forever once every session has stopped
+		while len([s for s in sessions if s.is_alive()]) > 0:
+			try:
+				requests.put(request,timeout=1)
+				return
+			except Queue.Full:
+				pass
+	
+	def submit(sql,using_data,rows):
+		for session in sessions:
+			if session.error is not None:
+				raise Exception('Insert failed: {0}'.format(session.error))
+		put((sql,using_data,rows))
+	
+	batcher = using_insert_batcher(tbl,fields,submit,args.pack)
+	sent = False
+	
+	try:
+		with open(csv_file,'r') as f:
+			reader = csv.reader(f)
+			td_types = csv_td_types(ddf,next(reader,None),column,args.dest)
+			#the batcher takes one record at a time
+			encode_csv_rows(td_types,reader,batcher,batch_size=1)
+			batcher.flush()
+		sent = True
+	finally:
+		if sent is False:
+			#stop sending - rows from requests already executed stay inserted
+			try:
+				while True:
+					requests.get_nowait()
+			except Queue.Empty:
+				pass
+		
+		#one None stops one session
+		for session in sessions:
+			put(None)
+		for session in sessions:
+			session.join()
+	
+	for session in sessions:
+		if session.error is not None:
+			raise Exception('Insert failed: {0}'.format(session.error))
+	
+	return results
+
+def csv_fields(ddf,csv_file,args):
+	"""returns the field definitions matching the csv header, in csv order
+	- the same list csv_to_fexp returns, without encoding any rows"""
+	
+	if args.use_column_titles is True:
+		column = 'Title'
+	else:
+		column = 'Name'
+	
+	with open(csv_file,'r') as f:
+		fieldnames = csv.DictReader(f).fieldnames
+	
+	return [td_type.fd for td_type in csv_td_types(ddf,fieldnames,column,args.dest)]
+
+def csv_to_fexp(ddf,csv_file,fexp_file,args,on_error=None):
+	"""binary safe conversion from csv to fast-export binary format
+	
+	ddf - contains definitions of all fields in the csv (and potential fields not in the csv)
+	csv_file - filename of csv we read from
+	fexp_file - filename of fexp file we write to
+	args - arguments passed by the user (eg verbosity)
+	on_error - called with the exception if encoding fails, before fexp_file
+			   is closed (closing a fifo tells its reader the data is complete)
+	
+	
+	returns the actual ddfs used
+	"""
+	
+	if args.use_column_titles is True:
+		column = 'Title'
+	else:
+		column = 'Name'
+	
+	with open(csv_file,'r') as f:
+		
+		reader = csv.reader(f)
+		fieldnames = next(reader,None)
+		
+		td_types = csv_td_types(ddf,fieldnames,column,args.dest)
+		
+		if getattr(args,'workers',1) <= 1:
+			out = open(fexp_file,'wb')
+			
+			try:
+				encode_csv_rows(td_types,reader,out)
+			except Exception as e:
+				error = sys.exc_info()
+				
+				if on_error is not None:
+					on_error(e)
 				
-				out.write(rph.pack_row(len(td_types)))
+				try:
+					out.close()
+				except IOError:
+					#EPIPE - on_error stopped the reader
+					pass
+				
+				raise error[0],error[1],error[2]
+			
+			out.close()
 			
+			if args.verbose is True:
+				print_cache_stats(td_types)
+			
+			return [td_type.fd for td_type in td_types]
+	
+	try:
+		parts = csv_to_fexp_parts(ddf,csv_file,fexp_file,fieldnames,column,args.dest,args.workers)
+	except Exception as e:
+		if on_error is not None:
+			on_error(e)
+		raise
+	
+	#stitch the parts together in order
+	with open(fexp_file,'wb') as out:
+		for part in parts:
+			with open(part,'rb') as input:
+				shutil.copyfileobj(input,out)
+			os.remove(part)
+	
 	return [td_type.fd for td_type in td_types]
+
+class column_stats:
+	"""mergeable statistics of the cells of one csv column - a count of each
+	detected type, the length range of non-empty cells and the precision and
+	scale DECIMAL cells need
+	
+	Two bounded size sketches of the non-empty values are kept too:
+	* the most frequent values (space saving) - up to 2 * top_k counters,
+	  trimmed to top_k, a new value starting at the largest count trimmed
+	* the distinct_k smallest value hashes (k minimum values), from which
+	  the number of distinct values is estimated"""
+	
+	top_k = 256
+	distinct_k = 1024
+	hash_range = 2 * (sys.maxsize + 1)
+	
+	#tried in order, the first match is the cell's type
+	classifiers = [(k,re.compile('[\s]*{0}[\s]*$'.format(v))) for k,v in
+					[	('INT'		,'[-+]?[0-9]{1,9}')
+					,	('DECIMAL'	,'[-+]?([0-9]{10,18})()')
+					,	('DECIMAL'	,'[-+]?([0-9]*)\.([0-9]+)')
+					,	('FLOAT'	,'[-+]?[0-9]*\.?[0-9]+[eE][-+]?[0-9]+')
+					,	("DATE FORMAT 'YYYY-MM-DD'",'[0-9]{2,4}[-|/][0-9]{1,2}[-|/][0-9]{1,2}')
+					]]
+	
+	def __init__(self,name):
+		self.Name = name
+		self.types = {}
+		self.min_length = 65536
+		self.max_length = 0
+		self.prec = 0
+		self.scale = 0
+		self.counts = {}
+		self.floor = 0
+		self.hashes = []			#heap of -hash
+		self.hashed = set()
+	
+	def insert(self,cell):
+		
+		type = self.classify(cell)
+		self.types[type] = self.types.get(type,0) + 1
+		
+		if type != 'EMPTY':
+			self.min_length = min(self.min_length,len(cell))
+			self.max_length = max(self.max_length,len(cell))
+			
+			if cell in self.counts:
+				self.counts[cell] += 1
+			else:
+				self.counts[cell] = self.floor + 1
+				if len(self.counts) > 2 * self.top_k:
+					self.trim()
+			
+			#hash() of short strings clusters, multiplying spreads it over the range
+			h = (hash(cell) * 0x9e3779b97f4a7c15) & (self.hash_range - 1)
+			if h not in self.hashed and (len(self.hashes) < self.distinct_k or h < -self.hashes[0]):
+				self.add_hash(h)
+	
+	def classify(self,cell):
+		
+		if cell is None or len(cell) == 0:
+			return 'EMPTY'
+		
+		for k,pattern in self.classifiers:
+			m = pattern.match(cell)
+			if m is not None:
+				if k == 'DECIMAL':
+					self.prec = max(self.prec,len(m.group(1)) + len(m.group(2)))
+					self.scale = max(self.scale,len(m.group(2)))
+				return k
+		
+		return 'CHAR'
+	
+	def trim(self):
+		
+		counts = sorted(self.counts.iteritems(),key=lambda k:k[1],reverse=True)
+		self.floor = max(self.floor,counts[self.top_k][1])
+		self.counts = dict(counts[:self.top_k])
+	
+	def add_hash(self,h):
+		
+		heapq.heappush(self.hashes,-h)
+		self.hashed.add(h)
+		
+		if len(self.hashes) > self.distinct_k:
+			self.hashed.remove(-heapq.heappop(self.hashes))
+	
+	def frequent(self,min_count=1):
+		"""returns (value,count) for the values certainly seen at least
+		min_count times, most frequent first - count is a lower bound"""
+		
+		return sorted([(v,n - self.floor) for v,n in self.counts.iteritems() if n - self.floor >= min_count],
+					  key=lambda k:k[1],reverse=True)
+	
+	def distinct(self):
+		"""estimates the number of distinct non-empty values"""
+		
+		if len(self.hashes) < self.distinct_k:
+			return len(self.hashes)
+		
+		#the kth smallest of n uniform hashes is around k/n of the range
+		return int((self.distinct_k - 1) * float(self.hash_range) / (-self.hashes[0] + 1))
+	
+	def merge(self,other):
+		"""adds the statistics of other (for the same column) to these"""
+		
+		for type,count in other.types.iteritems():
+			self.types[type] = self.types.get(type,0) + count
+		
+		self.min_length = min(self.min_length,other.min_length)
+		self.max_length = max(self.max_length,other.max_length)
+		self.prec = max(self.prec,other.prec)
+		self.scale = max(self.scale,other.scale)
+		
+		#a value missing from one side may have been counted up to its floor
+		for v in set(self.counts) | set(other.counts):
+			self.counts[v] = self.counts.get(v,self.floor) + other.counts.get(v,other.floor)
+		self.floor += other.floor
+		
+		if len(self.counts) > self.top_k:
+			self.trim()
+		
+		for h in other.hashed:
+			if h not in self.hashed and (len(self.hashes) < self.distinct_k or h < -self.hashes[0]):
+				self.add_hash(h)
+
+def insert_csv_rows(columns,reader,maxrows=None):
+	"""adds the cells of each row from csv reader to columns (column_stats)
+	
+	returns (rows,complete) - complete is False if maxrows stopped the scan"""
+	
+	width = len(columns)
+	rows = 0
+	
+	for row in reader:
+		
+		if len(row) == 0:
+			continue
+		
+		if maxrows is not None and rows >= maxrows:
+			return rows,False
+		
+		rows += 1
+		
+		if len(row) < width:
+			row.extend([None] * (width - len(row)))
+		
+		for c,cell in zip(columns,row):
+			c.insert(cell)
+	
+	return rows,True
+
+def csv_records(lines):
+	"""joins lines into whole csv records - a newline only ends a record
+	when an even number of quote characters have been seen"""
+	
+	record = []
+	quotes = 0
+	
+	for line in lines:
+		record.append(line)
+		quotes += line.count('"')
+		
+		if quotes % 2 == 0:
+			yield ''.join(record)
+			record = []
+			quotes = 0
+	
+	if len(record) > 0:
+		yield ''.join(record)
+
+def scan_csv_range(task):
+	"""scans one byte range of a csv file - runs in a worker process so
+	takes a single picklable tuple
+	
+	returns (column_stats,rows,complete), or with a sample size
+	(sampled records,records in the range)"""
+	
+	csv_file,fieldnames,start,end,maxrows,sample = task
+	
+	with open(csv_file,'rb') as f:
+		
+		lines = read_csv_range(f,start,end)
+		
+		if sample is None:
+			columns = [column_stats(name) for name in fieldnames]
+			rows,complete = insert_csv_rows(columns,csv.reader(lines),maxrows)
+			return columns,rows,complete
+		
+		#reservoir sampling - the records aren't parsed until they're chosen
+		rng = random.Random()
+		reservoir = []
+		seen = 0
+		
+		for record in csv_records(lines):
+			if len(reservoir) < sample:
+				reservoir.append(record)
+			else:
+				i = rng.randint(0,seen)
+				if i < sample:
+					reservoir[i] = record
+			seen += 1
+		
+		return reservoir,seen
+
+def merge_samples(samples,size,rng=random):
+	"""merges (sample,population) pairs - each a uniform sample of its own
+	population - into a uniform sample of up to size items of them all"""
+	
+	pools = []
+	remaining = []
+	
+	for sample,population in samples:
+		sample = list(sample)
+		rng.shuffle(sample)
+		pools.append(sample)
+		remaining.append(population)
+	
+	merged = []
+	
+	while len(merged) < size and sum(remaining) > 0:
+		
+		#pick a population in proportion to what's left of it
+		pick = rng.randint(0,sum(remaining) - 1)
+		i = 0
+		while pick >= remaining[i]:
+			pick -= remaining[i]
+			i += 1
+		
+		merged.append(pools[i].pop())
+		remaining[i] -= 1
+	
+	return merged
+
+def scan_csv(csv_file,maxrows=None,sample=None,workers=1):
+	"""collects column_stats for each column of a csv file
+	
+	maxrows - only scan the first maxrows rows (in one process)
+	sample - only classify a uniform sample of this many rows of the file
+	otherwise every row is scanned, in byte ranges split between workers
+	
+	returns (column_stats,rows scanned,rows in the file or None if unknown)"""
+	
+	with open(csv_file,'rb') as f:
+		fieldnames = next(csv.reader(f),None)
+	
+	if fieldnames is None:
+		raise Exception("'{0}' is empty".format(csv_file))
+	
+	if maxrows is not None:
+		workers = 1
+	
+	tasks = [(csv_file,fieldnames,start,end,maxrows,sample)
+				for start,end,lines_before in split_csv_file(csv_file,workers)]
+	
+	if workers > 1 and len(tasks) > 1:
+		import multiprocessing
+		
+		pool = multiprocessing.Pool(min(workers,len(tasks)))
+		try:
+			results = pool.map(scan_csv_range,tasks)
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+	else:
+		results = [scan_csv_range(task) for task in tasks]
+	
+	if sample is not None:
+		columns = [column_stats(name) for name in fieldnames]
+		records = merge_samples(results,sample)
+		rows,complete = insert_csv_rows(columns,csv.reader(records))
+		return columns,rows,sum(seen for reservoir,seen in results)
+	
+	columns = [column_stats(name) for name in fieldnames]
+	rows = 0
+	complete = True
+	
+	for range_columns,range_rows,range_complete in results:
+		for c,range_c in zip(columns,range_columns):
+			c.merge(range_c)
+		rows += range_rows
+		complete = complete and range_complete
+	
+	if complete is True:
+		return columns,rows,rows
+	
+	return columns,rows,None
@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+#
+# 	 dwhwrapper - cli wrapper for Teradata data warehouse utilities (BTEQ,etc..)
+#    Copyright (C) 2012 Felix Barbalet, Corporate Analytics, Australian Taxation Office, Commonwealth of Australia
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    tdemu.py - stands in for a Teradata system, to test and profile dwh offline
+#
+#    * emulated_cliv2 answers dbc_connection's DBCHINI/DBCHCL calls
+#    * 'tdemu.py dwh ARGS' runs dwh with every cliv2 session it opens
+#      answered by emulated_cliv2 instead of libcliv2.so
+#    * 'tdemu.py bteq|fexp|fastload|mload' runs the utility script on stdin,
+#      writing or reading INDICDATA files and printing what the real utility
+#      prints about them
+#    * 'tdemu.py install DIR' writes bteq, fexp, fastload and mload commands
+#      into DIR, to put at the front of the PATH
+#
+#    It is for testing only, so isn't installed with dwh. The emulated system
+#    is described by the spec file named by DWH_EMULATOR - a json file of
+#    synthetic tables, and how fast the emulated system is, eg
+#        {"latency": 0.05, "rows_per_sec": 200000,
+#         "tables": {"db.sales": {"profile": "narrow", "rows": 100000, "seed": 1},
+#                    "db.names": {"columns": [["ID","INTEGER",4],["NAME","VARCHAR",30]]}},
+#         "failures": [["DROP TABLE", "3807 Object does not exist."]]}
+#
+#    * latency - seconds added to each logon and request
+#    * rows_per_sec - the rate rows are exported and imported at
+#    * failures - requests matching a regex fail with the message
+#
+#    A query returns every column of the first table it selects from, whatever
+#    its select list, limited to one slice of a partitioned export (see
+#    partition_query in dwh). Rows sent to the emulator are read and counted,
+#    but not stored.
+
+import sys
+import os
+import ctypes
+import struct
+import json
+import random
+import re
+import time
+import zlib
+import csv
+
+import tdcli
+
+def field(name,type,length,nulls=True):
+	return {'Name':name,'Title':name,'Type':type,'Len':length,'Nulls':nulls,'Format':''}
+
+#(type,length) of each column, and the share of NULL cells
+profiles = {
+	'narrow':			([('INTEGER',4),('DATE',4),('DECIMAL',[9,2]),('CHAR',3),('VARCHAR',20)],0.1),
+	'wide_numeric':		([('INTEGER',4),('SMALLINT',2),('BYTEINT',1),('DECIMAL',[18,4]),('FLOAT',8),('DATE',4)] * 10,0.05),
+	'varchar_heavy':	([('INTEGER',4)] + [('VARCHAR',60)] * 12,0.05),
+	'null_heavy':		([('INTEGER',4),('DATE',4),('DECIMAL',[9,2]),('CHAR',3),('VARCHAR',20)] * 4,0.8),
+}
+
+def profile_ddf(profile):
+	return [field('c{0}'.format(i),type,length) for i,(type,length) in enumerate(profiles[profile][0])]
+
+def random_value(fd,rng):
+	"""returns a random csv value that fits field definition fd"""
+
+	t = fd['Type']
+
+	if t == 'INTEGER':
+		return str(rng.randint(-2**31,2**31-1))
+	elif t == 'SMALLINT':
+		return str(rng.randint(-2**15,2**15-1))
+	elif t == 'BYTEINT':
+		return str(rng.randint(-128,127))
+	elif t == 'FLOAT':
+		return repr(rng.uniform(-1e6,1e6))
+	elif t == 'DATE':
+		return '{0:04d}-{1:02d}-{2:02d}'.format(rng.randint(1900,2100),rng.randint(1,12),rng.randint(1,28))
+	elif t == 'DECIMAL':
+		prec,scale = fd['Len']
+		digits = ''.join(rng.choice('0123456789') for i in range(0,rng.randint(1,prec)))
+		if scale > 0:
+			digits = digits.rjust(scale + 1,'0')
+			digits = '{0}.{1}'.format(digits[:-scale],digits[-scale:])
+		return rng.choice(['','-']) + digits
+	elif t == 'CHAR':
+		return ''.join(rng.choice('abcdefgh ') for i in range(0,fd['Len'])).strip()
+	elif t == 'VARCHAR':
+		return ''.join(rng.choice('abcdefgh ,"\n') for i in range(0,rng.randint(0,fd['Len'])))
+
+	raise Exception('No random values for {0}'.format(t))
+
+def random_rows(ddf,rows,null_share,rng):
+	"""yields rows of random csv values - empty values are NULL"""
+
+	for i in xrange(0,rows):
+		yield ['' if rng.random() < null_share else random_value(fd,rng) for fd in ddf]
+
+def write_csv(ddf,csv_file,rows,null_share,rng):
+
+	with open(csv_file,'wb') as f:
+		w = csv.writer(f)
+		w.writerow([fd['Name'] for fd in ddf])
+		w.writerows(random_rows(ddf,rows,null_share,rng))
+
+#PrepInfo data type codes, for columns that allow nulls
+type_codes = {'VARCHAR':449,'CHAR':453,'DECIMAL':485,'FLOAT':481,
+			  'INTEGER':497,'SMALLINT':501,'DATE':753,'BYTEINT':757}
+
+def prepinfo_parcel(ddf,cost_est=1.0):
+	"""returns a PrepInfo parcel describing the columns of ddf"""
+
+	parcel = struct.pack('=dHH',cost_est,0,len(ddf))
+
+	for fd in ddf:
+		if fd['Type'] == 'DECIMAL':
+			#precision in the high byte, scale in the low
+			data_len = fd['Len'][0] << 8 | fd['Len'][1]
+		else:
+			data_len = fd['Len']
+
+		name,format,title = fd['Name'],fd['Format'],fd['Title']
+		parcel += struct.pack('=HHH{0}sH{1}sH{2}s'.format(len(name),len(format),len(title)),
+							  type_codes[fd['Type']],data_len,len(name),name,len(format),format,len(title),title)
+
+	return parcel
+
+class emulated_failure(Exception):
+	"""a request the emulated system rejects"""
+
+	def __init__(self,code,message):
+		Exception.__init__(self,'Failure {0} {1}'.format(code,message))
+		self.code = code
+		self.message = message
+
+class throttle:
+	"""sleeps so that no more than rate rows pass each second"""
+
+	def __init__(self,rate):
+		self.rate = rate
+		self.t0 = time.time()
+
+	def wait(self,rows):
+		if self.rate is not None:
+			ahead = rows / float(self.rate) - (time.time() - self.t0)
+			if ahead > 0:
+				time.sleep(ahead)
+
+class emulated_table:
+	"""the synthetic rows of a table - the same every time they are read"""
+
+	def __init__(self,name,spec):
+		self.name = name
+
+		if 'profile' in spec:
+			self.ddf = profile_ddf(spec['profile'])
+			null_share = profiles[spec['profile']][1]
+		else:
+			self.ddf = [field(str(name),str(type),length) for name,type,length in spec['columns']]
+			null_share = 0.0
+
+		self.rows = spec.get('rows',1000)
+		self.null_share = spec.get('nulls',null_share)
+		self.seed = spec.get('seed',0)
+
+	def values(self,part=None):
+		"""yields the csv values of each row - part is (column,slices,slice)
+		to only yield the rows of one slice"""
+
+		rows = random_rows(self.ddf,self.rows,self.null_share,random.Random(self.seed))
+
+		if part is None:
+			return rows
+
+		col,slices,i = part
+		return (r for r in rows if (zlib.crc32(r[col]) & 0xffffffff) % slices == i)
+
+class csv_values:
+	"""wraps rows of csv values as a csv reader for tdcli.row_encoder"""
+
+	def __init__(self,rows):
+		self.rows = rows
+		self.line_num = 0
+
+	def __iter__(self):
+		for r in self.rows:
+			self.line_num += 1
+			yield r
+
+class emulated_system:
+	"""the tables and speed of an emulated Teradata system"""
+
+	def __init__(self,spec):
+		self.latency = spec.get('latency',0)
+		self.rows_per_sec = spec.get('rows_per_sec')
+		self.failures = [(re.compile(pattern,re.IGNORECASE),message) for pattern,message in spec.get('failures',[])]
+		self.tables = dict((name.lower(),emulated_table(name,t)) for name,t in spec.get('tables',{}).iteritems())
+
+	def delay(self):
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+	def check(self,sql):
+		"""raises the scripted failure of sql, if it has one"""
+
+		for pattern,message in self.failures:
+			if pattern.search(sql) is not None:
+				code,message = (message.split(' ',1) + [''])[:2]
+				raise emulated_failure(code,message)
+
+	def query(self,sql):
+		"""returns the table sql selects from and the slice of it, or None
+		for the table if sql selects from a dictionary view or nothing"""
+
+		self.check(sql)
+
+		tables = re.findall('\\bfrom\\s+([a-z0-9_\\.$#]+)',sql,re.IGNORECASE)
+
+		if len(tables) == 0 or tables[0].lower().startswith('dbc.'):
+			return None,None
+
+		if tables[0].lower() not in self.tables:
+			raise emulated_failure(3807,"Object '{0}' does not exist.".format(tables[0]))
+
+		table = self.tables[tables[0].lower()]
+
+		m = re.search('hashbucket\\s*\\(\\s*hashrow\\s*\\(\\s*dwh_part\\.([a-z0-9_$#]+)\\s*\\)\\s*\\)\\s*mod\\s+([0-9]+)\\s*=\\s*([0-9]+)',
+					  sql,re.IGNORECASE)
+
+		if m is None:
+			return table,None
+
+		names = [fd['Name'].lower() for fd in table.ddf]
+		return table,(names.index(m.group(1).lower()),int(m.group(2)),int(m.group(3)))
+
+	def ddf(self,sql):
+		table,part = self.query(sql)
+
+		if table is None:
+			raise emulated_failure(3706,'Syntax error: emulated queries must select from a table.')
+
+		return table.ddf
+
+	def records(self,sql):
+		"""yields the indicator mode record of each row sql returns, without
+		the length and end of record newline an export adds"""
+
+		table,part = self.query(sql)
+
+		if table is None:
+			return
+
+		encoder = tdcli.row_encoder(tdcli.get_td_types(table.ddf),0)
+		limit = throttle(self.rows_per_sec)
+
+		for rows,r in enumerate(table.values(part)):
+			end = encoder.encode(r,0)
+			yield str(encoder.batch[2:end - 1])
+			limit.wait(rows)
+
+	def export(self,sql,out):
+		"""writes the rows of sql to file object out as an INDICDATA export
+
+		returns the number of rows written"""
+
+		table,part = self.query(sql)
+
+		if table is None:
+			return 0
+
+		encoder = tdcli.row_encoder(tdcli.get_td_types(table.ddf))
+		limit = throttle(self.rows_per_sec)
+		rows = 0
+		values = table.values(part)
+
+		while True:
+			#a thousand rows at a time, so the rate limit is smooth
+			batch = encoder.encode_rows(csv_values(r for i,r in zip(xrange(0,1000),values)),out)
+			if batch == 0:
+				return rows
+			rows += batch
+			limit.wait(rows)
+
+	def consume(self,input):
+		"""reads the INDICDATA records of file object input
+
+		returns the number of records read"""
+
+		limit = throttle(self.rows_per_sec)
+		rows = 0
+
+		for record in tdcli.raw_reader(input,65536):
+			rows += 1
+			if rows % 1000 == 0:
+				limit.wait(rows)
+
+		return rows
+
+def load_spec(spec_file=None):
+	"""returns the emulated_system described by spec_file, by default the
+	file named by DWH_EMULATOR"""
+
+	if spec_file is None:
+		spec_file = os.environ['DWH_EMULATOR']
+
+	with open(spec_file,'r') as f:
+		return emulated_system(json.load(f))
+
+class dbc_area(ctypes.Structure):
+	"""the fields of the cliv2 DBCAREA that dbc_connection uses, so the
+	emulator works without the generated dbcarea.py"""
+
+	_fields_ = [
+			("total_len",ctypes.c_int32)
+		,	("func",ctypes.c_int32)
+		] + [(name,ctypes.c_char) for name in [
+			'change_opts','resp_mode','use_presence_bits','keep_resp','wait_across_crash',
+			'tell_about_crash','loc_mode','var_len_req','var_len_fetch','save_resp_buf',
+			'two_resp_bufs','ret_time','parcel_mode','wait_for_resp','req_proc_opt','maximum_parcel']
+		] + [
+			("logon_ptr",ctypes.POINTER(ctypes.c_char))
+		,	("logon_len",ctypes.c_uint32)
+		,	("req_ptr",ctypes.POINTER(ctypes.c_char))
+		,	("req_len",ctypes.c_uint32)
+		,	("using_data_ptr",ctypes.POINTER(ctypes.c_char))
+		,	("using_data_len",ctypes.c_uint16)
+		,	("fet_data_ptr",ctypes.POINTER(ctypes.c_char))
+		,	("fet_ret_data_len",ctypes.c_uint32)
+		,	("fet_parcel_flavor",ctypes.c_uint32)
+		,	("msg_text",ctypes.c_char * 248)
+	]
+
+class emulated_cliv2:
+	"""stands in for libcliv2.so - each request is answered with the parcels
+	the emulated system would send"""
+
+	dbc_area = dbc_area
+
+	def __init__(self,system=None):
+		if system is None:
+			system = load_spec()
+		self.system = system
+		self.parcels = iter([])
+		self.buffer = None
+
+	def DBCHINI(self,result,cnta,dbcarea):
+		result._obj.value = tdcli.dbc_connection.EM_OK
+
+	def DBCHCLN(self,result,cnta):
+		result._obj.value = tdcli.dbc_connection.EM_OK
+
+	def DBCHCL(self,result,cnta,dbcarea):
+
+		area = dbcarea._obj
+		result._obj.value = tdcli.dbc_connection.EM_OK
+
+		if area.func == tdcli.dbc_connection.DBFCON:
+			self.system.delay()
+			self.parcels = iter([])
+
+		elif area.func == tdcli.dbc_connection.DBFIRQ:
+			self.system.delay()
+			sql = ctypes.string_at(area.req_ptr,area.req_len)
+			self.parcels = self.respond(sql,area)
+
+		elif area.func == tdcli.dbc_connection.DBFFET:
+
+			try:
+				flavor,data = next(self.parcels)
+			except StopIteration:
+				result._obj.value = tdcli.dbc_connection.REQEXHAUST
+				return
+			except emulated_failure as e:
+				flavor,data = self.failure(e)
+
+			#keep a reference so the parcel isn't freed while it's being read
+			self.buffer = ctypes.create_string_buffer(data,len(data))
+			area.fet_parcel_flavor = flavor
+			area.fet_data_ptr = ctypes.cast(self.buffer,ctypes.POINTER(ctypes.c_char))
+			area.fet_ret_data_len = len(data)
+
+		elif area.func == tdcli.dbc_connection.DBFERQ:
+			self.parcels = iter([])
+
+	def failure(self,e):
+		msg = e.message[:255]
+		return tdcli.dbc_connection.PclFAILURE,struct.pack('=HHHH255s',1,0,int(e.code),len(msg),msg)
+
+	def respond(self,sql,area):
+		"""yields the (flavor,data) of each parcel answering sql - failures
+		are raised as the parcels are fetched, like the real thing"""
+
+		if area.req_proc_opt == 'P':
+			yield tdcli.dbc_connection.PclPREPINFO,prepinfo_parcel(self.system.ddf(sql))
+			yield tdcli.dbc_connection.PclSUCCESS,struct.pack('=HIHHHH',1,0,0,0,0,0)
+
+		elif area.using_data_len > 0:
+			#a row of using data for each statement, one row inserted by each
+			self.system.check(sql)
+			for i in range(0,max(1,sql.upper().count('INSERT INTO'))):
+				if i == 0:
+					yield tdcli.dbc_connection.PclSUCCESS,struct.pack('=HIHHHH',1,1,0,0,0,0)
+				else:
+					yield tdcli.dbc_connection.PclOK,struct.pack('=HHIHHH',i + 1,0,1,0,0,0)
+
+		else:
+			for record in self.system.records(sql):
+				yield tdcli.dbc_connection.PclRECORD,record
+
+def script_statements(script):
+	"""yields the commands (.XXX) and sql statements of a utility script"""
+
+	statement = []
+
+	for l in script.splitlines():
+
+		if len(statement) == 0 and (len(l.strip()) == 0 or l.strip()[:2] == '--'):
+			continue
+
+		statement.append(l)
+
+		#commands are a line each, sql statements end with a semicolon
+		if statement[0].strip()[:1] == '.' or l.rstrip().endswith(';'):
+			yield '\n'.join(statement)
+			statement = []
+
+	if len(statement) > 0:
+		yield '\n'.join(statement)
+
+def quoted_file(command):
+	"""returns the file named in a .EXPORT/.IMPORT/.DEFINE command"""
+
+	m = re.search('(?:file\\s*=\\s*|outfile\\s+|infile\\s+)(\'[^\']*\'|[^\\s;]+)',command,re.IGNORECASE)
+
+	if m is None:
+		raise emulated_failure(3706,'No file in {0}'.format(command))
+
+	return m.group(1).strip("'")
+
+def run_utility(utility,script,system,out=sys.stdout,err=sys.stderr):
+	"""runs a bteq/fexp/fastload/mload script against the emulated system
+
+	returns the utility's return code"""
+
+	export_file = None
+	import_file = None
+	load_file = None
+
+	try:
+		for s in script_statements(script):
+
+			command = s.strip().upper()
+
+			if utility == 'bteq' and command[:1] != '.' and import_file is None:
+				print >> out,'+---------+---------+---------+---------+---------+---------+'
+				print >> out,s
+
+			if command.startswith('.LOGON'):
+				system.delay()
+				print >> out,' *** Logon successfully completed.'
+
+			elif command.startswith('.LOGOFF'):
+				print >> out,' *** You are now logged off from the DBC.'
+
+			elif command.startswith('.EXPORT RESET'):
+				export_file = None
+
+			elif command.startswith('.EXPORT'):
+				export_file = quoted_file(s)
+
+			elif command.startswith('.IMPORT'):
+				if utility == 'mload':
+					load_file = quoted_file(s)
+				else:
+					import_file = quoted_file(s)
+
+			elif command.startswith('.DEFINE'):
+				load_file = quoted_file(s)
+
+			elif command.startswith('.END LOADING') or command.startswith('.END MLOAD'):
+				if load_file is None:
+					raise emulated_failure(3706,'Nothing to load')
+
+				with open(load_file,'rb') as f:
+					rows = system.consume(f)
+
+				if utility == 'fastload':
+					print >> out,'     Total Records Read              =  {0}'.format(rows)
+					print >> out,'     Total Error Table 1             =  0  ---- Table has been dropped'
+					print >> out,'     Total Error Table 2             =  0  ---- Table has been dropped'
+					print >> out,'     Total Inserts Applied           =  {0}'.format(rows)
+					print >> out,'     Total Duplicate Rows            =  0'
+				else:
+					print >> out,'     Inserts:         {0}'.format(rows)
+
+			elif command[:1] == '.':
+				pass
+
+			elif import_file is not None:
+				#the USING statement is repeated for each record of the file
+				system.check(s)
+				with open(import_file,'rb') as f:
+					rows = system.consume(f)
+				print >> out,' *** Starting Row 0 at {0}'.format(time.ctime())
+				print >> out,' *** Total number of statements: {0},  Accepted : {0},  Rejected : 0'.format(rows)
+				import_file = None
+
+			elif export_file is not None:
+				system.delay()
+				with open(export_file,'wb') as f:
+					rows = system.export(s,f)
+
+				if utility == 'fexp':
+					print >> out,'**** {0} UTY8722 {1} total records written to output file.'.format(time.strftime('%H:%M:%S'),rows)
+				else:
+					print >> out,' *** Success, Stmt# 1 ActivityCount = {0}'.format(rows)
+
+			elif utility == 'bteq':
+				system.delay()
+				table,part = system.query(s)
+
+				if table is None:
+					print >> out,' *** Success, Stmt# 1 ActivityCount = 0'
+				else:
+					values = list(table.values(part))
+					print >> out,' *** Query completed. {0} rows found. {1} columns returned.'.format(len(values),len(table.ddf))
+					print >> out,''
+					print >> out,' '.join(fd['Name'] for fd in table.ddf)
+					for r in values:
+						print >> out,' '.join(v if len(v) > 0 else '?' for v in r)
+					print >> out,''
+
+			else:
+				#sql run by fastload/mload (the INSERT applied to each record)
+				system.check(s)
+
+	except emulated_failure as e:
+		print >> err,' *** {0}'.format(e)
+		return 8
+	except IOError as e:
+		print >> err,' *** Error: {0}'.format(e)
+		return 8
+
+	return 0
+
+def install(bin_dir):
+	"""writes a bteq, fexp, fastload and mload command into bin_dir, each
+	running this script"""
+
+	if not os.path.isdir(bin_dir):
+		os.makedirs(bin_dir)
+
+	for utility in ['bteq','fexp','fastload','mload']:
+		command = os.path.join(bin_dir,utility)
+
+		with open(command,'w') as f:
+			f.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'.format(sys.executable,os.path.abspath(__file__),utility))
+
+		os.chmod(command,0755)
+
+def run_dwh(argv):
+	"""runs the dwh script next to this file with argv, its cliv2 sessions
+	answered by the emulated system - it never borrows sessions from a
+	broker, and caches column definitions next to the spec file"""
+
+	import tdbroker
+
+	system = load_spec()
+	tdcli.load_cliv2 = lambda: emulated_cliv2(system)
+
+	#~/.dwh_cache belongs to the real system - a broker there would answer
+	#with real data, and cached definitions would be used by real runs
+	cache_dir = '{0}.cache'.format(os.path.abspath(os.environ['DWH_EMULATOR']))
+	tdcli.DDF_CACHE_DIR = os.path.join(cache_dir,'ddf')
+	tdbroker.SOCKET_PATH = os.path.join(cache_dir,'broker.sock')
+	tdbroker.borrow = lambda *args,**kw: None
+
+	print '### using the emulated Teradata system in {0}'.format(os.environ['DWH_EMULATOR'])
+
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)),'dwh')
+	sys.argv = [script] + argv
+	execfile(script,{'__name__':'__main__','__file__':script})
+
+if __name__ == '__main__':
+
+	if len(sys.argv) == 3 and sys.argv[1] == 'install':
+		install(sys.argv[2])
+	elif len(sys.argv) >= 2 and sys.argv[1] == 'dwh':
+		run_dwh(sys.argv[2:])
+	elif len(sys.argv) >= 2 and sys.argv[1] in ['bteq','fexp','fastload','mload']:
+		sys.exit(run_utility(sys.argv[1],sys.stdin.read(),load_spec()))
+	else:
+		print >> sys.stderr,'usage: tdemu.py install DIR | tdemu.py dwh ARGS | tdemu.py bteq|fexp|fastload|mload < script'
+		print >> sys.stderr,'(the emulated system is described by the spec file named by DWH_EMULATOR)'
+		sys.exit(2)
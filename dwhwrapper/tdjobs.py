@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# 	 dwhwrapper - cli wrapper for Teradata data warehouse utilities (BTEQ,etc..)
+#    Copyright (C) 2012 Felix Barbalet, Corporate Analytics, Australian Taxation Office, Commonwealth of Australia
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    tdjobs.py - runs a manifest of sql scripts with dependencies concurrently
+#
+#    * a manifest is a json list of jobs, eg
+#        [{"name": "stage", "script": "stage.sql"},
+#         {"name": "load", "script": "load.sql", "after": ["stage"], "estimate": 600}]
+#    * scripts are relative to the manifest, names default to the script's name
+#    * ready jobs are started longest path to the end of the batch first (the
+#      critical path), timed by "estimate" seconds or by the job's last
+#      successful run (~/.dwh_cache/job_times.json)
+#    * the descendants of a failed job are skipped, other jobs still run
+
+import json
+import os
+import time
+import threading
+import Queue
+import heapq
+
+TIMES_FILE = os.path.join(os.path.expanduser('~'),'.dwh_cache','job_times.json')
+
+class job:
+	"""one script of a manifest
+
+	status - waiting, running, done, failed or skipped"""
+
+	def __init__(self,name,script,after=(),estimate=None):
+		self.name = name
+		self.script = script
+		self.after = list(after)
+		self.estimate = estimate
+		self.priority = None
+		self.status = 'waiting'
+		self.elapsed = None
+		self.error = None
+
+def load_manifest(manifest_file):
+	"""returns the jobs of a json manifest file, in manifest order"""
+
+	with open(manifest_file,'r') as f:
+		entries = json.load(f)
+
+	base_dir = os.path.dirname(os.path.abspath(manifest_file))
+	jobs = []
+
+	for entry in entries:
+
+		if 'script' not in entry:
+			raise Exception("Manifest entry {0} has no 'script'".format(json.dumps(entry)))
+
+		script = os.path.join(base_dir,entry['script'].encode('utf-8'))
+
+		if not os.path.isfile(script):
+			raise Exception("Job script '{0}' not found".format(script))
+
+		name = entry.get('name',os.path.splitext(os.path.basename(script))[0])
+
+		jobs.append(job(name.encode('utf-8'),script,
+						[a.encode('utf-8') for a in entry.get('after',[])],entry.get('estimate')))
+
+	return jobs
+
+def load_times(times_file=TIMES_FILE):
+	"""returns the elapsed seconds of each script's last successful run"""
+
+	try:
+		with open(times_file,'r') as f:
+			return json.load(f)
+	except (IOError,ValueError):
+		return {}
+
+def save_times(jobs,times_file=TIMES_FILE):
+	"""records the elapsed time of each job that succeeded"""
+
+	times = load_times(times_file)
+
+	for j in jobs:
+		if j.status == 'done':
+			times[j.script] = j.elapsed
+
+	times_dir = os.path.dirname(times_file)
+
+	if not os.path.isdir(times_dir):
+		os.makedirs(times_dir,0700)
+
+	#write then rename, so concurrent runs never read half a file
+	tmp = '{0}.{1}'.format(times_file,os.getpid())
+	fd = os.open(tmp,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0600)
+	with os.fdopen(fd,'w') as f:
+		json.dump(times,f)
+	os.rename(tmp,times_file)
+
+class job_graph:
+	"""schedules jobs so that each starts once the jobs it is after are done
+
+	times - elapsed seconds by script, used when a job has no estimate"""
+
+	def __init__(self,jobs,times=None):
+
+		self.jobs = jobs
+		self.by_name = {}
+		self.children = {}
+
+		for j in jobs:
+			if j.name in self.by_name:
+				raise Exception("Job '{0}' is in the manifest twice".format(j.name))
+			self.by_name[j.name] = j
+			self.children[j.name] = []
+
+		for j in jobs:
+			for a in j.after:
+				if a not in self.by_name:
+					raise Exception("Job '{0}' is after unknown job '{1}'".format(j.name,a))
+				self.children[a].append(j)
+
+		if times is None:
+			times = {}
+
+		#a job's priority is the longest chain of estimates from its start to
+		#the end of the batch - children are always ordered before parents
+		for j in reversed(self.ordered()):
+
+			if j.estimate is not None:
+				estimate = j.estimate
+			else:
+				estimate = times.get(j.script,1)
+
+			j.priority = estimate + max([0] + [c.priority for c in self.children[j.name]])
+
+	def ordered(self):
+		"""returns the jobs with every job after the jobs it depends on"""
+
+		waiting = dict((j.name,len(j.after)) for j in self.jobs)
+		ready = [j for j in self.jobs if waiting[j.name] == 0]
+		ordered = []
+
+		while len(ready) > 0:
+			j = ready.pop(0)
+			ordered.append(j)
+
+			for c in self.children[j.name]:
+				waiting[c.name] -= 1
+				if waiting[c.name] == 0:
+					ready.append(c)
+
+		if len(ordered) != len(self.jobs):
+			raise Exception('Jobs {0} depend on each other'.format(
+				', '.join(j.name for j in self.jobs if waiting[j.name] > 0)))
+
+		return ordered
+
+	def skip(self,failed):
+		"""skips every job that depends, directly or not, on failed"""
+
+		pending = list(self.children[failed.name])
+
+		while len(pending) > 0:
+			j = pending.pop()
+			if j.status == 'waiting':
+				j.status = 'skipped'
+				j.error = "'{0}' failed".format(failed.name)
+				pending.extend(self.children[j.name])
+
+	def run_one(self,run_job,j,finished):
+
+		t0 = time.time()
+
+		try:
+			run_job(j)
+			j.status = 'done'
+		except Exception as e:
+			j.status = 'failed'
+			j.error = e
+
+		j.elapsed = time.time() - t0
+		finished.put(j)
+
+	def run(self,run_job,workers):
+		"""calls run_job(job) for every job, at most workers at once - a job
+		fails if run_job raises an exception
+
+		returns the number of jobs that didn't succeed"""
+
+		waiting = dict((j.name,len(j.after)) for j in self.jobs)
+		ready = [(-j.priority,i,j) for i,j in enumerate(self.jobs) if waiting[j.name] == 0]
+		heapq.heapify(ready)
+		finished = Queue.Queue()
+		running = 0
+
+		while len(ready) > 0 or running > 0:
+
+			while len(ready) > 0 and running < workers:
+				j = heapq.heappop(ready)[2]
+				j.status = 'running'
+
+				t = threading.Thread(target=self.run_one,args=(run_job,j,finished))
+				t.daemon = True
+				t.start()
+				running += 1
+
+			#a timeout keeps the wait interruptible with ctrl-c
+			while True:
+				try:
+					j = finished.get(True,1)
+					break
+				except Queue.Empty:
+					pass
+
+			running -= 1
+
+			if j.status == 'done':
+				for c in self.children[j.name]:
+					waiting[c.name] -= 1
+					if waiting[c.name] == 0 and c.status == 'waiting':
+						heapq.heappush(ready,(-c.priority,self.jobs.index(c),c))
+			else:
+				self.skip(j)
+
+		return len([j for j in self.jobs if j.status != 'done'])
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# 	 dwhwrapper - cli wrapper for Teradata data warehouse utilities (BTEQ,etc..)
+#    Copyright (C) 2012 Felix Barbalet, Corporate Analytics, Australian Taxation Office, Commonwealth of Australia
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    tdmetrics.py - per-stage timings of a dwh run
+#
+#    * each stage (logon, get_ddf, export, convert, encode, import, ...)
+#      records its wall and cpu seconds, rows, bytes and the peak rss so far
+#    * cpu time is the whole process's, plus any child processes (utilities,
+#      worker pools) that exited during the stage - stages running at once in
+#      threads each count the other's cpu time
+#    * 'dwh --metrics FILE' appends one json line per run to FILE, and
+#      '--metrics -' prints it
+#
+#    Stages are only measured once start() has been called, so timing a
+#    stage costs nothing otherwise.
+
+import os
+import time
+import datetime
+import threading
+import resource
+
+def cpu_time():
+	"""returns the user+system seconds of this process and its waited for
+	children"""
+
+	s = resource.getrusage(resource.RUSAGE_SELF)
+	c = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+	return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+def peak_rss():
+	"""returns the largest resident set size, in kB, of this process or of
+	any of its waited for children"""
+
+	return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def per_second(count,seconds):
+	if count is None or seconds <= 0:
+		return None
+
+	return count / seconds
+
+class timed_stage:
+	"""a context manager timing one stage of a run - rows and bytes can be
+	set during the stage or once it has ended (eg from a utility's output)"""
+
+	def __init__(self,name,metrics):
+		self.name = name
+		self.metrics = metrics
+		self.rows = None
+		self.bytes = None
+
+	def __enter__(self):
+		if self.metrics is not None:
+			self.t0 = time.time()
+			self.cpu0 = cpu_time()
+		return self
+
+	def __exit__(self,type,value,traceback):
+		if self.metrics is not None:
+			self.wall = time.time() - self.t0
+			self.cpu = cpu_time() - self.cpu0
+			self.peak_rss = peak_rss()
+			self.failed = type is not None
+			self.metrics.add(self)
+		return False
+
+	def record(self):
+		return {
+			'name'			:self.name
+			,'start'		:round(self.t0 - self.metrics.t0,3)
+			,'wall'			:round(self.wall,3)
+			,'cpu'			:round(self.cpu,3)
+			,'rows'			:self.rows
+			,'bytes'		:self.bytes
+			,'rows_per_sec'	:per_second(self.rows,self.wall)
+			,'bytes_per_sec':per_second(self.bytes,self.wall)
+			,'peak_rss_kb'	:self.peak_rss
+			,'failed'		:self.failed
+		}
+
+class run_metrics:
+	"""collects the stages of a single dwh command"""
+
+	def __init__(self,command):
+		self.command = command
+		self.started = datetime.datetime.now()
+		self.t0 = time.time()
+		self.cpu0 = cpu_time()
+		self.stages = []
+		self.values = {}
+		self.error = None
+		self.lock = threading.Lock()
+
+	def add(self,stage):
+		with self.lock:
+			self.stages.append(stage)
+
+	def summary(self):
+		"""returns the run and its stages as a json serialisable dict"""
+
+		import socket
+
+		summary = {
+			'command'		:self.command
+			,'started'		:self.started.isoformat()
+			,'host'			:socket.gethostname()
+			,'pid'			:os.getpid()
+			,'status'		:'ok' if self.error is None else 'failed'
+			,'error'		:self.error
+			,'wall'			:round(time.time() - self.t0,3)
+			,'cpu'			:round(cpu_time() - self.cpu0,3)
+			,'peak_rss_kb'	:peak_rss()
+		}
+		summary.update(self.values)
+
+		with self.lock:
+			summary['stages'] = [stage.record() for stage in self.stages]
+
+		return summary
+
+	def write(self,metrics_file):
+		"""appends the summary to metrics_file as a line of json, or prints
+		it if metrics_file is -"""
+
+		import json
+
+		line = json.dumps(self.summary(),sort_keys=True)
+
+		if metrics_file == '-':
+			print line
+			return
+
+		#a single write, so runs appending to the same file at once don't
+		#interleave their lines
+		fd = os.open(metrics_file,os.O_WRONLY | os.O_CREAT | os.O_APPEND,0600)
+		try:
+			os.write(fd,'{0}\n'.format(line))
+		finally:
+			os.close(fd)
+
+#the run being measured, if any
+metrics = None
+
+def start(command):
+	"""starts measuring the stages of command"""
+
+	global metrics
+	metrics = run_metrics(command)
+	return metrics
+
+def stage(name):
+	"""returns a timed_stage, which is recorded if a run is being measured
+
+	with stage('convert') as s:
+		s.rows = convert()"""
+
+	return timed_stage(name,metrics)
+
+def note(**values):
+	"""adds values (eg the cost_est of the query) to the run's summary"""
+
+	if metrics is not None:
+		metrics.values.update(values)
+
+def failed(error):
+	if metrics is not None:
+		metrics.error = str(error)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# 	 dwhwrapper - cli wrapper for Teradata data warehouse utilities (BTEQ,etc..)
+#    Copyright (C) 2012 Felix Barbalet, Corporate Analytics, Australian Taxation Office, Commonwealth of Australia
+#
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    bench_tdcli.py - conversion throughput benchmarks for tdcli.py
+#
+#    * synthetic DDFs (the tdemu.py profiles: narrow, wide numeric, VARCHAR
+#      heavy, NULL heavy) with matching csv and binary indicdata files - no
+#      Teradata server needed
+#    * times csv_to_fexp, fexp_to_csv, fexp_to_columns, indic_data and the
+#      encode/decode of each type_* codec, in rows/s and MB/s
+#
+#    $ python tests/bench_tdcli.py --output before.json
+#    $ python tests/bench_tdcli.py --output after.json --compare before.json
+#    $ python tests/bench_tdcli.py --compare before.json after.json
+
+import sys
+import os
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import datetime
+
+import tdcli
+from tdemu import field, profiles, profile_ddf, random_value, write_csv
+
+#a single column of each type, for the codec benchmarks
+codecs = [('INTEGER',4),('SMALLINT',2),('BYTEINT',1),('FLOAT',8),('DATE',4),
+		  ('DECIMAL',[9,2]),('DECIMAL',[18,4]),('CHAR',10),('VARCHAR',40)]
+
+class bench_args:
+	"""stands in for the parsed dwh arguments"""
+
+	def __init__(self,**kw):
+		self.use_column_titles = False
+		self.verbose = False
+		self.workers = 1
+		self.dest = 'bench'
+		self.__dict__.update(kw)
+
+def best_time(function,repeat):
+	"""returns the fastest of repeat calls of function, in seconds"""
+
+	times = []
+
+	for i in range(0,repeat):
+		t0 = time.time()
+		function()
+		times.append(time.time() - t0)
+
+	return min(times)
+
+def result(seconds,rows,nbytes):
+	return {'seconds':seconds,
+			'rows_per_sec':rows / seconds if seconds > 0 else None,
+			'mb_per_sec':nbytes / 1048576.0 / seconds if seconds > 0 else None}
+
+def bench_profile(profile,rows,repeat,work_dir,rng):
+	"""times the file conversions of one profile"""
+
+	ddf = profile_ddf(profile)
+	csv_file = os.path.join(work_dir,'{0}.csv'.format(profile))
+	fexp_file = os.path.join(work_dir,'{0}.fexp'.format(profile))
+	out_file = os.path.join(work_dir,'{0}.out.csv'.format(profile))
+
+	write_csv(ddf,csv_file,rows,profiles[profile][1],rng)
+
+	results = {}
+
+	results['csv_to_fexp'] = result(best_time(lambda: tdcli.csv_to_fexp(ddf,csv_file,fexp_file,bench_args()),repeat),
+									rows,os.path.getsize(csv_file))
+
+	def to_csv():
+		if os.path.exists(out_file):
+			os.remove(out_file)
+		tdcli.fexp_to_csv(ddf,fexp_file,bench_args(output=out_file))
+
+	results['fexp_to_csv'] = result(best_time(to_csv,repeat),rows,os.path.getsize(fexp_file))
+
+	if tdcli.load_numpy() is not None:
+
+		def to_npy():
+			npy_dir = os.path.join(work_dir,'{0}.npy'.format(profile))
+			if os.path.exists(npy_dir):
+				shutil.rmtree(npy_dir)
+			tdcli.fexp_to_columns(ddf,fexp_file,bench_args(output=npy_dir,format='npy',batch_rows=65536))
+
+		results['fexp_to_npy'] = result(best_time(to_npy,repeat),rows,os.path.getsize(fexp_file))
+
+	#the indicator bytes of the file's rows
+	indic = tdcli.indic_data(len(ddf))
+
+	with open(fexp_file,'rb') as f:
+		indic_rows = [r[:indic.indic_data_len].tobytes() for r in tdcli.raw_reader(f)]
+
+	null_lists = [indic.unpack(r) for r in indic_rows]
+	bitsets = indic.unpack_rows(indic_rows)
+	nbytes = len(indic_rows) * indic.indic_data_len
+
+	results['indic_pack'] = result(best_time(lambda: [indic.pack(n) for n in null_lists],repeat),rows,nbytes)
+	results['indic_unpack'] = result(best_time(lambda: [indic.unpack(r) for r in indic_rows],repeat),rows,nbytes)
+	results['indic_pack_rows'] = result(best_time(lambda: indic.pack_rows(bitsets),repeat),rows,nbytes)
+	results['indic_unpack_rows'] = result(best_time(lambda: indic.unpack_rows(indic_rows),repeat),rows,nbytes)
+
+	return dict(('{0}/{1}'.format(profile,k),v) for k,v in results.iteritems())
+
+def bench_codec(type,length,rows,repeat,rng):
+	"""times one type_* codec encoding csv values and decoding binary values"""
+
+	fd = field('c',type,length)
+	values = [random_value(fd,rng) for i in range(0,rows)]
+
+	name = 'codec/{0}'.format(type if type != 'DECIMAL' else 'DECIMAL({0},{1})'.format(*length))
+	results = {}
+
+	#a new td_type each time, so memoised conversions start cold
+	results['encode'] = best_time(lambda: map(tdcli.get_td_types([fd])[0].encode,values),repeat)
+
+	rph = tdcli.row_pack_handler()
+	td_type = tdcli.get_td_types([fd])[0]
+	for v in values:
+		td_type.pack(rph,v)
+	packed = struct.pack('=' + ''.join(rph.format),*rph.data)
+
+	def decode():
+		td_type = tdcli.get_td_types([fd])[0]
+		
+		if isinstance(td_type,tdcli.type_varchar):
+			offset = 0
+			while offset < len(packed):
+				offset += td_type.unpack(packed,offset)[1]
+			return
+		
+		#as row_decoder does - unpack, then convert if it changes the value
+		fixed = struct.Struct('=' + td_type.data_type)
+		for offset in xrange(0,len(packed),fixed.size):
+			value = fixed.unpack_from(packed,offset)[0]
+			if td_type.converts is True:
+				td_type.convert(value)
+
+	results['decode'] = best_time(decode,repeat)
+
+	return dict(('{0}/{1}'.format(name,k),result(v,rows,len(packed))) for k,v in results.iteritems())
+
+def git_commit():
+	try:
+		return subprocess.Popen(['git','rev-parse','--short','HEAD'],stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+								cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or None
+	except OSError:
+		return None
+
+def run(args):
+
+	rng = random.Random(args.seed)
+	work_dir = tempfile.mkdtemp(prefix='bench_tdcli')
+	results = {}
+
+	try:
+		for profile in sorted(profiles):
+			if args.filter is None or args.filter in profile:
+				results.update(bench_profile(profile,args.rows,args.repeat,work_dir,rng))
+
+		for type,length in codecs:
+			if args.filter is None or args.filter in 'codec/{0}'.format(type):
+				results.update(bench_codec(type,length,args.rows,args.repeat,rng))
+	finally:
+		shutil.rmtree(work_dir)
+
+	return {'meta':{'created':datetime.datetime.now().isoformat(),
+					'commit':git_commit(),
+					'python':sys.version.split()[0],
+					'numpy':None if tdcli.load_numpy() is None else tdcli.numpy.__version__,
+					'rows':args.rows,
+					'repeat':args.repeat,
+					'seed':args.seed},
+			'results':results}
+
+def print_results(run):
+
+	width = max([len(k) for k in run['results']] + [10])
+	print '{0:<{1}} {2:>12} {3:>10}'.format('benchmark',width,'rows/s','MB/s')
+
+	for name in sorted(run['results']):
+		r = run['results'][name]
+		print '{0:<{1}} {2:>12,.0f} {3:>10.2f}'.format(name,width,r['rows_per_sec'],r['mb_per_sec'])
+
+def compare(base,new,tolerance):
+	"""prints the change in throughput of each benchmark in both runs
+
+	returns the number of benchmarks slower by more than tolerance"""
+
+	names = sorted(set(base['results']) & set(new['results']))
+	width = max([len(k) for k in names] + [10])
+	regressions = 0
+
+	print 'base: {0} ({1})  new: {2} ({3})'.format(base['meta']['commit'],base['meta']['created'],
+												   new['meta']['commit'],new['meta']['created'])
+	print '{0:<{1}} {2:>12} {3:>12} {4:>8}'.format('benchmark',width,'base rows/s','new rows/s','change')
+
+	for name in names:
+		b = base['results'][name]['rows_per_sec']
+		n = new['results'][name]['rows_per_sec']
+		change = n / b - 1
+
+		flag = ''
+		if change < -tolerance:
+			flag = ' REGRESSION'
+			regressions += 1
+
+		print '{0:<{1}} {2:>12,.0f} {3:>12,.0f} {4:>+8.1%}{5}'.format(name,width,b,n,change,flag)
+
+	return regressions
+
+def main():
+
+	parser = argparse.ArgumentParser(description='tdcli conversion throughput benchmarks')
+	parser.add_argument('--rows',metavar='N',type=int,default=20000,help='rows per benchmark - default is 20000')
+	parser.add_argument('--repeat',metavar='R',type=int,default=3,help='report the best of R runs - default is 3')
+	parser.add_argument('--seed',metavar='S',type=int,default=1,help='random seed for the synthetic data')
+	parser.add_argument('--filter',metavar='TEXT',help='only run benchmarks whose name contains TEXT')
+	parser.add_argument('--output',metavar='FILE',help='save the results as json')
+	parser.add_argument('--compare',metavar='FILE',nargs='+',help='compare with a saved run, or compare two saved runs')
+	parser.add_argument('--tolerance',metavar='T',type=float,default=0.1,help='report slowdowns of more than T (0.1 = 10%%) as regressions')
+	args = parser.parse_args()
+
+	if args.compare is not None and len(args.compare) == 2:
+		with open(args.compare[1]) as f:
+			new = json.load(f)
+	else:
+		new = run(args)
+		print_results(new)
+
+		if args.output is not None:
+			with open(args.output,'w') as f:
+				json.dump(new,f,indent=1,sort_keys=True)
+
+	if args.compare is not None:
+		with open(args.compare[0]) as f:
+			base = json.load(f)
+		print ''
+		if compare(base,new,args.tolerance) > 0:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -23,15 +23,47 @@ import random
 import struct
 import unittest
 import tdcli
+import tdbroker
+import tdjobs
+import tdmetrics
+import tdemu
 import os
 import ctypes
+import StringIO
+import tempfile
+import csv
+import argparse
+import shutil
+import threading
+import json
+import datetime
+import sys
+import imp
+import time
 
+def load_dwh():
+	"""imports the dwh script, which has no .py extension"""
+	
+	path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'dwh')
+	dwh = imp.new_module('dwh')
+	dwh.__file__ = path
+	execfile(path,dwh.__dict__)
+	
+	#as its main does
+	dwh.procs = []
+	dwh.fifos = []
+	return dwh
+
+dwh = load_dwh()
 
 class TestDBCArea(unittest.TestCase):
 	"""unit testing of TestDBCArea"""
 
 	def setUp(self):
-		self.dbc = tdcli.dbc_connection()
+		try:
+			self.dbc = tdcli.dbc_connection()
+		except (OSError,ImportError):
+			self.skipTest('cliv2 not installed')
 
 	def test_dbc_init(self):
 		"""cliv2 lib"""
@@ -47,6 +79,555 @@ class TestDBCArea(unittest.TestCase):
 		
 		self.assertNotEqual(self.dbc.dbcarea.tell_about_crash,'N')
 
+class canned_cliv2:
+	"""stands in for libcliv2.so, answering each request with canned parcels
+	
+	responses - dict of sql : list of (parcel flavor, parcel data)"""
+	
+	#so the generated dbcarea.py (and cliv2) isn't needed
+	dbc_area = tdemu.dbc_area
+	
+	def __init__(self,responses):
+		self.responses = responses
+		self.parcels = []
+		self.buffer = None
+		
+	def DBCHINI(self,result,cnta,dbcarea):
+		result._obj.value = tdcli.dbc_connection.EM_OK
+		
+	def DBCHCLN(self,result,cnta):
+		result._obj.value = tdcli.dbc_connection.EM_OK
+	
+	def DBCHCL(self,result,cnta,dbcarea):
+		
+		area = dbcarea._obj
+		result._obj.value = tdcli.dbc_connection.EM_OK
+		
+		if area.func == tdcli.dbc_connection.DBFCON:
+			self.parcels = []
+			
+		elif area.func == tdcli.dbc_connection.DBFIRQ:
+			sql = ctypes.string_at(area.req_ptr,area.req_len)
+			self.parcels = list(self.responses[sql])
+			
+		elif area.func == tdcli.dbc_connection.DBFFET:
+			
+			if len(self.parcels) == 0:
+				result._obj.value = tdcli.dbc_connection.REQEXHAUST
+				return
+			
+			flavor,data = self.parcels.pop(0)
+			#keep a reference so the parcel isn't freed while it's being read
+			self.buffer = ctypes.create_string_buffer(data,len(data))
+			area.fet_parcel_flavor = flavor
+			area.fet_data_ptr = ctypes.cast(self.buffer,ctypes.POINTER(ctypes.c_char))
+			area.fet_ret_data_len = len(data)
+
+class TestDirectFetch(unittest.TestCase):
+	"""fetch records in-process against a canned cliv2"""
+	
+	def test_fetch_records(self):
+		"""fetch_records"""
+		
+		sql = 'SELECT * FROM T;'
+		rows = [[1,'first'],[None,'second'],[3,None]]
+		
+		ddfs = [{'Name':'I','Title':'I','Type':'INTEGER','Len':4,'Nulls':True,'Format':'X'}
+			,	{'Name':'V','Title':'V','Type':'VARCHAR','Len':10,'Nulls':True,'Format':'X'}]
+		td_types = [tdcli.type_integer(ddfs[0]),tdcli.type_varchar(ddfs[1])]
+		
+		records = []
+		
+		for row in rows:
+			rph = tdcli.row_pack_handler()
+			for td_type,value in zip(td_types,row):
+				rph.define_null(value is None)
+				if value is None:
+					value = {'INTEGER':0,'VARCHAR':''}[td_type.fd['Type']]
+				rph.pack(td_type,str(value))
+			
+			#a record parcel is an export row without its length and newline
+			records.append((tdcli.dbc_connection.PclRECORD,rph.pack_row(2)[2:-1]))
+		
+		args = argparse.Namespace(verbose=False)
+		prepinfo = [(tdcli.dbc_connection.PclPREPINFO,tdemu.prepinfo_parcel(ddfs,1.5))]
+		
+		dbcc = tdcli.dbc_connection(canned_cliv2({sql:prepinfo}))
+		ddf = tdcli.get_ddf(sql,'dbc','uid','pw',args,dbcc)
+		self.assertEqual([fd['Type'] for fd in ddf['ddf']],['INTEGER','VARCHAR'])
+		
+		dbcc = tdcli.dbc_connection(canned_cliv2({sql:records}))
+		fetched = list(dbcc.fetch_records(sql))
+		self.assertEqual(fetched,[r[1] for r in records])
+		
+		decoder = tdcli.row_decoder(tdcli.get_td_types(ddf['ddf']))
+		self.assertEqual([decoder.decode(r,len(r)) for r in fetched],rows)
+
+	def test_execute_using(self):
+		"""execute_using activity counts"""
+		
+		sql = 'USING (c0_0 INTEGER) INSERT INTO T (I) VALUES (:c0_0);'
+		parcels = [(tdcli.dbc_connection.PclSUCCESS,struct.pack('=HIHHHH',1,1,0,0,0,0))
+				,	(tdcli.dbc_connection.PclOK,struct.pack('=HHIHHH',2,0,1,0,0,0))]
+		
+		dbcc = tdcli.dbc_connection(canned_cliv2({sql:parcels}))
+		self.assertEqual(dbcc.execute_using(sql,'\x00' + struct.pack('i',1)),[1,1])
+	
+	def test_using_insert_batcher(self):
+		"""using_insert_batcher request packing"""
+		
+		fields = [{'Name':'I','Title':'I','Type':'INTEGER','Len':4,'Nulls':True,'Format':'X','Types':'INTEGER'}
+			,	{'Name':'V','Title':'V','Type':'VARCHAR','Len':9000,'Nulls':True,'Format':'X','Types':'VARCHAR(9000)'}]
+		td_types = [tdcli.type_integer(fields[0]),tdcli.type_varchar(fields[1])]
+		
+		requests = []
+		batcher = tdcli.using_insert_batcher('T',fields,
+						lambda sql,data,rows: requests.append((sql,data,rows)),7)
+		
+		nulls = []
+		
+		for i in range(0,random.randint(1,100)):
+			rph = tdcli.row_pack_handler()
+			rph.pack(td_types[0],str(i))
+			rph.pack(td_types[1],ISO8859(random.randint(0,9000)))
+			row_nulls = [bool(random.randint(0,1)),bool(random.randint(0,1))]
+			rph.nulls = row_nulls
+			nulls.extend(row_nulls)
+			batcher.write(rph.pack_row(2))
+		
+		batcher.flush()
+		
+		self.assertEqual(sum(r[2] for r in requests),len(nulls) / 2)
+		
+		for sql,data,rows in requests:
+			self.assertTrue(rows <= 7)
+			self.assertTrue(len(data) <= batcher.max_data)
+			self.assertEqual(sql.count('INSERT INTO T (I,V)'),rows)
+			
+			indic = tdcli.indic_data(rows * 2)
+			self.assertEqual(indic.unpack(data[:indic.indic_data_len]),nulls[:rows * 2])
+			nulls = nulls[rows * 2:]
+
+class TestEmulator(unittest.TestCase):
+	"""the emulated Teradata system in tdemu.py"""
+	
+	def setUp(self):
+		self.system = tdemu.emulated_system({'tables':{'db.t':{'profile':'narrow','rows':500,'seed':3}},
+											 'failures':[['DROP','3807 Object does not exist.']]})
+		self.work_dir = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.work_dir)
+	
+	def test_cliv2(self):
+		"""emulated_cliv2 prepinfo, records, using and failures"""
+		
+		args = argparse.Namespace(verbose=False)
+		dbcc = tdcli.dbc_connection(tdemu.emulated_cliv2(self.system))
+		dbcc.logon('dbc','uid','pw')
+		
+		ddf = tdcli.get_ddf('SELECT * FROM db.t;',None,None,None,args,dbcc)
+		self.assertEqual(ddf['ddf'],tdemu.profile_ddf('narrow'))
+		
+		decoder = tdcli.row_decoder(tdcli.get_td_types(ddf['ddf']))
+		rows = [decoder.decode(r,len(r)) for r in dbcc.fetch_records('SELECT * FROM db.t;')]
+		self.assertEqual(len(rows),500)
+		self.assertEqual(rows[0][4],list(self.system.tables['db.t'].values())[0][4])
+		
+		#the slices of a partitioned export don't overlap
+		slices = [list(dbcc.fetch_records('SELECT * FROM (SELECT * FROM db.t) AS dwh_part '
+										  'WHERE HASHBUCKET(HASHROW(dwh_part.c3)) MOD 3 = {0};'.format(i)))
+				  for i in range(0,3)]
+		self.assertEqual(sorted(sum(slices,[])),sorted(dbcc.fetch_records('SELECT * FROM db.t;')))
+		self.assertTrue(min(len(s) for s in slices) > 0)
+		
+		self.assertEqual(dbcc.execute_using('INSERT INTO db.t (c0) VALUES (:a);INSERT INTO db.t (c0) VALUES (:b);','\x00'),[1,1])
+		self.assertRaises(Exception,list,dbcc.fetch_records('DROP TABLE db.t;'))
+		self.assertRaises(Exception,tdcli.get_ddf,'SELECT * FROM db.none;',None,None,None,args,dbcc)
+		
+		dbcc.logout()
+	
+	def test_utilities(self):
+		"""run_utility exports and imports indicdata files"""
+		
+		raw_file = os.path.join(self.work_dir,'t.raw')
+		out = StringIO.StringIO()
+		
+		script = ".LOGTABLE t_log;\n.LOGON dbc/uid,pw;\n.BEGIN EXPORT SESSIONS 2;\n" \
+				 ".EXPORT OUTFILE '{0}' MODE INDICATOR FORMAT FASTLOAD;\nSELECT * FROM db.t;\n.END EXPORT;\n.LOGOFF;\n".format(raw_file)
+		self.assertEqual(tdemu.run_utility('fexp',script,self.system,out),0)
+		self.assertTrue('UTY8722 500 total records' in out.getvalue())
+		
+		with open(raw_file,'rb') as f:
+			self.assertEqual(sum(1 for r in tdcli.raw_reader(f)),500)
+		
+		script = ".LOGON dbc/uid,pw;\n.IMPORT INDICDATA FILE = '{0}';\n.REPEAT * PACK 50;\n" \
+				 "USING (c0 INTEGER)\n\tINSERT INTO db.t (c0)\n\t VALUES (:c0);\n.LOGOFF;\n".format(raw_file)
+		out = StringIO.StringIO()
+		self.assertEqual(tdemu.run_utility('bteq',script,self.system,out),0)
+		self.assertTrue('Total number of statements: 500,  Accepted : 500,  Rejected : 0' in out.getvalue())
+		
+		err = StringIO.StringIO()
+		self.assertEqual(tdemu.run_utility('bteq','.LOGON dbc/uid,pw;\nDROP TABLE db.t;\n',self.system,out,err),8)
+		self.assertTrue('3807' in err.getvalue())
+
+class TestBroker(unittest.TestCase):
+	"""borrow pooled sessions from a broker against a canned cliv2"""
+	
+	def setUp(self):
+		self.socket_dir = tempfile.mkdtemp()
+		self.logons = []
+		self.dbc_connection = tdbroker.dbc_connection
+		
+		responses = {'SELECT 1;':[(tdcli.dbc_connection.PclRECORD,'\x00\x01')]}
+		
+		def connect():
+			self.logons.append(1)
+			return tdcli.dbc_connection(canned_cliv2(responses))
+		
+		tdbroker.dbc_connection = connect
+		
+		self.broker = tdbroker.broker(os.path.join(self.socket_dir,'broker.sock'),pool_size=2)
+		self.server = threading.Thread(target=self.broker.serve)
+		self.server.start()
+		
+	def tearDown(self):
+		self.broker.shutdown()
+		self.server.join()
+		tdbroker.dbc_connection = self.dbc_connection
+		shutil.rmtree(self.socket_dir)
+	
+	def test_broker(self):
+		"""broker_session requests and session reuse"""
+		
+		session = tdbroker.borrow('dbc','uid','pw',self.broker.socket_path)
+		self.assertNotEqual(session,None)
+		
+		for i in range(0,3):
+			self.assertEqual(list(session.fetch_records('SELECT 1;')),['\x00\x01'])
+		self.assertEqual(len(self.logons),1)
+		
+		#a failed request logs off the session it used
+		self.assertRaises(Exception,list,session.fetch_records('SELECT 2;'))
+		self.assertEqual(list(session.fetch_records('SELECT 1;')),['\x00\x01'])
+		self.assertEqual(len(self.logons),2)
+		
+		#other credentials get their own pool
+		other = tdbroker.borrow('dbc','uid','other',self.broker.socket_path)
+		self.assertEqual(list(other.fetch_records('SELECT 1;')),['\x00\x01'])
+		self.assertEqual(len(self.logons),3)
+		
+		self.assertEqual(tdbroker.borrow('dbc','uid','pw',os.path.join(self.socket_dir,'none')),None)
+	
+	def test_no_prepinfo(self):
+		"""a broker reply without a PrepInfo parcel"""
+		
+		class done_only:
+			def request(self,request):
+				return iter([])
+		
+		session = tdbroker.broker_session(done_only(),'dbc','uid','pw')
+		self.assertRaisesRegexp(Exception,'No PrepInfo parcel',session.get_prepinfo_parcel,'SELECT 1;')
+
+class TestJobs(unittest.TestCase):
+	
+	def graph(self,*jobs):
+		return tdjobs.job_graph([tdjobs.job(name,name,after,estimate) for name,after,estimate in jobs])
+	
+	def test_critical_path(self):
+		"""job_graph starts the longest chain first"""
+		
+		graph = self.graph(('short',[],4.5),('a',[],1),('b',['a'],1),('c',['b'],4))
+		self.assertEqual([j.priority for j in graph.jobs],[4.5,6,5,4])
+		
+		started = []
+		self.assertEqual(graph.run(lambda j: started.append(j.name),1),0)
+		self.assertEqual(started,['a','b','short','c'])
+	
+	def test_failure(self):
+		"""job_graph skips the descendants of a failed job"""
+		
+		def run_job(j):
+			if j.name == 'bad':
+				raise Exception('bad job')
+		
+		graph = self.graph(('a',[],None),('bad',['a'],None),('b',['bad','a'],None),('c',['b'],None),('d',['a'],None))
+		self.assertEqual(graph.run(run_job,3),3)
+		self.assertEqual([j.status for j in graph.jobs],['done','failed','skipped','skipped','done'])
+		self.assertEqual(str(graph.jobs[1].error),'bad job')
+	
+	def test_invalid(self):
+		"""job_graph cycles and unknown jobs"""
+		
+		self.assertRaises(Exception,self.graph,('a',['c'],None),('b',['a'],None),('c',['b'],None))
+		self.assertRaises(Exception,self.graph,('a',['x'],None))
+		self.assertRaises(Exception,self.graph,('a',[],None),('a',[],None))
+
+class TestMetrics(unittest.TestCase):
+	
+	def tearDown(self):
+		tdmetrics.metrics = None
+	
+	def test_stages(self):
+		"""run_metrics records stages as a json line, failed ones too"""
+		
+		self.assertEqual(tdmetrics.stage('unmeasured').__enter__().metrics,None)
+		
+		tdmetrics.start('dwh get')
+		
+		with tdmetrics.stage('convert') as s:
+			s.bytes = 1000
+		s.rows = 10
+		
+		try:
+			with tdmetrics.stage('import'):
+				raise ValueError('bad')
+		except ValueError as e:
+			tdmetrics.failed(e)
+		
+		tdmetrics.note(cost_est=1.5)
+		
+		d = tempfile.mkdtemp()
+		try:
+			metrics_file = os.path.join(d,'metrics.json')
+			tdmetrics.metrics.write(metrics_file)
+			tdmetrics.metrics.write(metrics_file)
+			
+			with open(metrics_file,'r') as f:
+				runs = [json.loads(l) for l in f]
+		finally:
+			shutil.rmtree(d)
+		
+		self.assertEqual(len(runs),2)
+		self.assertEqual((runs[0]['command'],runs[0]['status'],runs[0]['error'],runs[0]['cost_est']),('dwh get','failed','bad',1.5))
+		self.assertEqual([(st['name'],st['rows'],st['bytes'],st['failed']) for st in runs[0]['stages']],
+						 [('convert',10,1000,False),('import',None,None,True)])
+		self.assertTrue(runs[0]['peak_rss_kb'] > 0)
+
+class TestExecCmd(unittest.TestCase):
+	
+	def test_handler_error(self):
+		"""a failing stdout handler kills the utility instead of leaving it
+		blocked on a full pipe"""
+		
+		def stdout_handler(l):
+			raise IOError('broken pipe')
+		
+		cmd = [sys.executable,'-c','for i in xrange(0,500000): print i']
+		errors = []
+		
+		def run():
+			try:
+				dwh.exec_cmd(argparse.Namespace(verbose=False),cmd,'',stdout_handler=stdout_handler)
+			except IOError as e:
+				errors.append(e)
+		
+		stdout = sys.stdout
+		sys.stdout = StringIO.StringIO()
+		try:
+			t = threading.Thread(target=run)
+			t.daemon = True
+			t.start()
+			t.join(20)
+		finally:
+			sys.stdout = stdout
+		
+		self.assertFalse(t.is_alive())
+		self.assertEqual(len(errors),1)
+		self.assertEqual(dwh.procs,[])
+
+	def test_stream_export_failed(self):
+		"""the reader of a streamed export isn't left blocked opening the
+		fifo when the utility exits before it gets there"""
+		
+		d = tempfile.mkdtemp()
+		fifo = os.path.join(d,'t.fifo')
+		os.mkfifo(fifo)
+		
+		path = os.environ['PATH']
+		stdout = sys.stdout
+		read = []
+		
+		def reader():
+			with open(fifo,'rb') as f:
+				read.append(f.read())
+		
+		try:
+			#no bteq to run
+			os.environ['PATH'] = d
+			sys.stdout = StringIO.StringIO()
+			
+			done_reading = threading.Event()
+			exporter = dwh.stream_export(argparse.Namespace(fexp=False,stream=True,verbose=False),'',fifo,done_reading)
+			
+			#the reader is late
+			time.sleep(0.5)
+			
+			t = threading.Thread(target=reader)
+			t.daemon = True
+			t.start()
+			t.join(10)
+			done_reading.set()
+			exporter.wait()
+		finally:
+			os.environ['PATH'] = path
+			sys.stdout = stdout
+			shutil.rmtree(d)
+		
+		self.assertEqual(read,[''])
+		self.assertRaises(OSError,exporter.result)
+
+	def sharded_import(self,bteq,scripts):
+		"""runs sharded_import with bteq as the bteq command"""
+		
+		d = tempfile.mkdtemp()
+		
+		with open(os.path.join(d,'bteq'),'w') as f:
+			f.write(bteq)
+		os.chmod(os.path.join(d,'bteq'),0755)
+		
+		path = os.environ['PATH']
+		stdout = sys.stdout
+		
+		try:
+			os.environ['PATH'] = '{0}:{1}'.format(d,path)
+			sys.stdout = StringIO.StringIO()
+			
+			return dwh.sharded_import(argparse.Namespace(verbose=False,input='t.csv'),scripts)
+		finally:
+			os.environ['PATH'] = path
+			sys.stdout = stdout
+			shutil.rmtree(d)
+	
+	def test_sharded_import_rejects(self):
+		"""a shard rejecting rows doesn't stop the other shards, any other
+		non-zero return code does"""
+		
+		#rejects a row of shard 0, and takes a while over shard 1
+		results = self.sharded_import('#!/bin/sh\n'
+				'if grep -q shard0; then rc=8; r=1; else sleep 0.5; rc=0; r=0; fi\n'
+				'echo " *** Total number of statements: 5,  Accepted : $((5-r)),  Rejected : $r"\n'
+				'exit $rc\n',['shard0\n','shard1\n'])
+		
+		self.assertEqual(dwh.bteq_import_counts(''.join(stdout for stdout,stderr in results)),(10,9,1))
+		
+		#shard 0 fails without rejecting rows, or writing to stderr
+		self.assertRaises(Exception,self.sharded_import,'#!/bin/sh\n'
+				'if grep -q shard0; then echo " *** Failure 2631 Transaction ABORTED"; exit 8; fi\n'
+				'echo " *** Total number of statements: 5,  Accepted : 5,  Rejected : 0"\n',['shard0\n','shard1\n'])
+		
+		#shard 0 imports nothing
+		self.assertRaises(Exception,self.sharded_import,'#!/bin/sh\n'
+				'grep -q shard0 && exit 0\n'
+				'echo " *** Total number of statements: 5,  Accepted : 5,  Rejected : 0"\n',['shard0\n','shard1\n'])
+
+class TestPartitions(unittest.TestCase):
+	
+	def test_column_names(self):
+		"""partitioned exports need every column to have a distinct name"""
+		
+		args = argparse.Namespace(partition_key='id')
+		field = tdemu.field
+		
+		for names,error in [(['id','Count(*)'],"alias 'Count(*)'"),
+							(['id','(a+1)',''],"alias '(a+1)', ''"),
+							(['id','x','X'],"'x' repeated")]:
+			try:
+				dwh.partitioned_export([field(n,'INTEGER',4) for n in names],'SELECT 1;','dbc','uid','pw',args)
+				self.fail('{0} exported'.format(names))
+			except Exception as e:
+				self.assertTrue(error in str(e),str(e))
+		
+		self.assertEqual(dwh.partition_query('SELECT * FROM t;','id',4,1),
+						 'SELECT * FROM (SELECT * FROM t) AS dwh_part WHERE HASHBUCKET(HASHROW(dwh_part.id)) MOD 4 = 1;')
+
+class TestTableDetection(unittest.TestCase):
+	
+	def setUp(self):
+		self.d = tempfile.mkdtemp()
+		
+	def tearDown(self):
+		shutil.rmtree(self.d)
+	
+	def create_table(self,header,rows):
+		csv_file = os.path.join(self.d,'t.csv')
+		with open(csv_file,'wb') as f:
+			w = csv.writer(f)
+			w.writerow(header)
+			w.writerows(rows)
+		
+		stdout = sys.stdout
+		sys.stdout = StringIO.StringIO()
+		try:
+			dwh.csv_detection(csv_file).scan(None)
+			return sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+	
+	def test_primary_index_not_compressed(self):
+		"""the primary index column gets no COMPRESS clause, and values seen
+		exactly pi_skew of the time aren't compressed"""
+		
+		#id is unique but for one empty cell, v has one value in exactly 1% of rows
+		rows = [[i if i != 500 else '',i if i % 100 != 0 else 'x'] for i in range(0,1000)]
+		
+		ddl = self.create_table(['id','v'],rows)
+		
+		self.assertTrue('PRIMARY INDEX (id)' in ddl,ddl)
+		self.assertTrue('\nid SMALLINT\n' in ddl,ddl)
+		self.assertFalse("'x'" in ddl,ddl)
+		
+		#the pi is still chosen first when another column is compressed
+		rows = [[i,'a' if i % 2 == 0 else 'b'] for i in range(0,1000)]
+		ddl = self.create_table(['id','v'],rows)
+		
+		self.assertTrue('PRIMARY INDEX (id)' in ddl,ddl)
+		self.assertTrue("v CHAR(1) COMPRESS ('a','b')" in ddl or "v CHAR(1) COMPRESS ('b','a')" in ddl,ddl)
+
+class TestDDFCache(unittest.TestCase):
+	
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+	
+	def test_cache(self):
+		"""ddf_cache keys, ttl and last alter invalidation"""
+		
+		result = {'sql_query':'SELECT * FROM T;','cost_est':0.5,
+				  'ddf':[{'Name':'D\xe9c','Title':'D\xe9c','Type':'DECIMAL','Len':[9,2],
+						  'Nulls':True,'Format':'---------9.99'}]}
+		
+		cache = tdcli.ddf_cache(60,self.cache_dir)
+		self.assertEqual(cache.get('dbc','uid',result['sql_query']),None)
+		
+		cache.put('dbc','uid',result['sql_query'],result,'2012-01-01 00:00:00.000000')
+		
+		self.assertEqual(cache.get('DBC','UID',"select *\n  from t -- comment\n;"),result)
+		self.assertEqual(cache.get('dbc','uid',result['sql_query'],'2012-01-01 00:00:00.000000'),result)
+		self.assertEqual(cache.get('dbc','uid',result['sql_query'],'2012-06-01 00:00:00.000000'),None)
+		self.assertEqual(cache.get('dbc','other',result['sql_query']),None)
+		
+		#quoted literals keep their case
+		self.assertNotEqual(tdcli.normalise_sql("select 'A'"),tdcli.normalise_sql("select 'a'"))
+		
+		expired = tdcli.ddf_cache(-1,self.cache_dir)
+		self.assertEqual(expired.get('dbc','uid',result['sql_query']),None)
+		
+	def test_quoted_spans(self):
+		"""whitespace, comment markers and case inside quotes change the key"""
+		
+		for a,b in [("SELECT 'a  b' AS x FROM t","SELECT 'a b' AS x FROM t"),
+					("SELECT 'x--1'","SELECT 'x--12345'"),
+					("SELECT '/*' AS a, '*/' AS b","SELECT '/**/' AS b"),
+					('SELECT 1 AS "Foo"','SELECT 1 AS "FOO"'),
+					('SELECT "a  b" FROM t','SELECT "a b" FROM t')]:
+			self.assertNotEqual(tdcli.normalise_sql(a),tdcli.normalise_sql(b))
+		
+		self.assertEqual(tdcli.normalise_sql("SELECT  'it''s  --x' AS \"Y\" -- don't\nFROM  T /* 'z */;"),
+						 "select 'it''s  --x' as \"Y\" from t")
+
 class TestPrepParcelHandling(unittest.TestCase):
 	"""test the PrepInfoColumn class"""
 	
@@ -138,7 +719,434 @@ class TestIndicData(unittest.TestCase):
 		self.assertEqual(len(self.nulls),len(unpacked_nulls))
 		
 		self.assertEqual(unpacked_nulls,self.nulls)
+	
+	def test_bitsets(self):
+		"""IndicData bitsets"""
+		
+		bitset = sum(1 << col for col,null in enumerate(self.nulls) if null is True)
+		bytes = self.indic_data.pack(self.nulls)
+		
+		self.assertEqual(self.indic_data.unpack_bitset(bytes),bitset)
+		self.assertEqual(self.indic_data.pack_bitset(bitset),bytes)
+		
+		rows = [self.indic_data.pack(self.nulls[i:] + self.nulls[:i]) for i in range(0,10)]
+		self.assertEqual(self.indic_data.pack_rows(self.indic_data.unpack_rows(rows)),rows)
+		
+
+class TestRawReader(unittest.TestCase):
+	
+	def test_block_spanning(self):
+		"""raw_reader records spanning blocks"""
+		
+		ddf = {'Name': 'TestVC', 'Format': 'X(300)', 'Nulls': True,
+			   'Len': 300, 'Title': 'TestVC', 'Type': 'VARCHAR'}
+		vc = tdcli.type_varchar(ddf)
+		
+		rows = []
+		data = []
+		for i in range(0,random.randint(1,50)):
+			row = ISO8859(random.randint(0,300))
+			rph = tdcli.row_pack_handler()
+			rph.pack(vc,row)
+			rph.define_null(False)
+			rows.append(row)
+			data.append(rph.pack_row(1))
+		
+		decoder = tdcli.row_decoder([vc])
+		
+		for block_size in [1,7,64,65536]:
+			
+			reader = tdcli.raw_reader(StringIO.StringIO(''.join(data)),block_size)
+			decoded = [decoder.decode(r,len(r))[0] for r in reader]
+			
+			self.assertEqual(decoded,rows)
+	
+	def test_split(self):
+		"""split_raw_file record aligned ranges"""
+		
+		ddf = {'Name': 'TestVC', 'Format': 'X(300)', 'Nulls': True,
+			   'Len': 300, 'Title': 'TestVC', 'Type': 'VARCHAR'}
+		vc = tdcli.type_varchar(ddf)
+		decoder = tdcli.row_decoder([vc])
+		
+		rows = []
+		fd,fexp_file = tempfile.mkstemp()
+		
+		with os.fdopen(fd,'wb') as out:
+			for i in range(0,random.randint(1,200)):
+				row = ISO8859(random.randint(0,300))
+				rph = tdcli.row_pack_handler()
+				rph.pack(vc,row)
+				rph.define_null(False)
+				rows.append(row)
+				out.write(rph.pack_row(1))
+		
+		try:
+			for parts in [1,2,7,500]:
+				decoded = []
+				
+				for start,end in tdcli.split_raw_file(fexp_file,parts,block_size=100):
+					with open(fexp_file,'rb') as input:
+						for r in tdcli.raw_reader(input,start=start,end=end):
+							decoded.append(decoder.decode(r,len(r))[0])
+				
+				self.assertEqual(decoded,rows)
+			
+			with open(fexp_file,'rb') as input:
+				data = input.read()
+			
+			for shards in [1,3,500]:
+				shard_files = tdcli.shard_raw_file(fexp_file,shards)
+				
+				try:
+					self.assertTrue(len(shard_files) <= shards)
+					self.assertEqual(''.join(open(f,'rb').read() for f in shard_files),data)
+					
+					for f in shard_files:
+						with open(f,'rb') as input:
+							self.assertTrue(len(list(tdcli.raw_reader(input))) > 0)
+				finally:
+					for f in shard_files:
+						os.remove(f)
+		finally:
+			os.remove(fexp_file)
+	
+	def test_truncated(self):
+		"""raw_reader truncated file"""
+		
+		reader = tdcli.raw_reader(StringIO.StringIO(struct.pack('H',10) + 'abc'))
+		self.assertRaises(Exception,list,reader)
+	
+	def test_parallel_csv(self):
+		"""fexp_to_csv with workers writes the same csv as a single process"""
+		
+		d = tempfile.mkdtemp()
+		
+		try:
+			#narrow has a VARCHAR, wide_numeric is fixed width (so is split
+			#without walking its records)
+			for profile in ['narrow','wide_numeric']:
+				ddf = tdemu.profile_ddf(profile)
+				csv_file = os.path.join(d,'{0}.csv'.format(profile))
+				fexp_file = os.path.join(d,'{0}.fexp'.format(profile))
+				
+				tdemu.write_csv(ddf,csv_file,3000,tdemu.profiles[profile][1],random.Random(5))
+				tdcli.csv_to_fexp(ddf,csv_file,fexp_file,argparse.Namespace(use_column_titles=False,verbose=False,dest='t'))
+				
+				output = []
+				
+				for workers in [1,3]:
+					out_file = os.path.join(d,'{0}.{1}.csv'.format(profile,workers))
+					args = argparse.Namespace(use_column_titles=False,verbose=False,workers=workers,output=out_file)
+					rows = tdcli.fexp_to_csv(ddf,fexp_file,args)
+					
+					with open(out_file,'rb') as f:
+						output.append((rows,f.read()))
+				
+				self.assertEqual(output[0][0],3000)
+				self.assertEqual(output[1],output[0])
+		finally:
+			shutil.rmtree(d)
+
+class TestColumnar(unittest.TestCase):
+	"""npy and arrow output of batches of raw records"""
+	
+	rows = [[1,'2012-02-29','-.05','ab ','x'],[None,'1899-12-31',None,'cd ',None],
+			[-3,None,'12345.67',None,''],[4,'2100-01-01','0.00','ef ','yz']]
+	
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		
+		ddf = [{'Name':n,'Title':n,'Type':t,'Len':l,'Nulls':True,'Format':'X'} for n,t,l in
+				[('I','INTEGER',4),('D','DATE',4),('DEC','DECIMAL',[9,2]),('C','CHAR',3),('V','VARCHAR',5)]]
+		self.fixed = ddf[:4]
+		self.ddf = ddf
+		
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	
+	def export(self,ddf):
+		
+		fexp_file = os.path.join(self.dir,'export.raw')
+		td_types = tdcli.get_td_types(ddf)
+		
+		with open(fexp_file,'wb') as f:
+			for row in self.rows:
+				rph = tdcli.row_pack_handler()
+				for td_type,value in zip(td_types,row):
+					rph.define_null(value is None)
+					if value is not None:
+						rph.pack(td_type,str(value))
+					elif td_type.fd['Type'] in ['CHAR','VARCHAR']:
+						rph.pack(td_type,'')
+					else:
+						rph.add_data(td_type,0)
+				f.write(rph.pack_row(len(td_types)))
+		
+		return fexp_file
+	
+	def convert(self,ddf,format,output):
+		args = argparse.Namespace(use_column_titles=False,format=format,output=output,batch_rows=3)
+		return tdcli.fexp_to_columns(ddf,self.export(ddf),args)
+	
+	def expected(self,ddf):
+		
+		columns = []
+		
+		for col,fd in enumerate(ddf):
+			values = [row[col] for row in self.rows]
+			if fd['Type'] == 'DATE':
+				values = [None if v is None else datetime.date(*map(int,v.split('-'))) for v in values]
+			elif fd['Type'] == 'DECIMAL':
+				values = [None if v is None else int(v.replace('.','')) for v in values]
+			columns.append(values)
+		
+		return columns
+	
+	def test_npy(self):
+		"""fexp_to_columns npy output"""
+		
+		if tdcli.load_numpy() is None:
+			self.skipTest('numpy not installed')
+		
+		for ddf in [self.fixed,self.ddf]:
+			output = os.path.join(self.dir,'npy')
+			self.assertEqual(self.convert(ddf,'npy',output),len(self.rows))
+			
+			with open(os.path.join(output,'columns.json')) as f:
+				columns = json.load(f)
+			
+			for column,expected in zip(columns,self.expected(ddf)):
+				values = tdcli.numpy.load(os.path.join(output,column['file']))
+				nulls = tdcli.numpy.load(os.path.join(output,column['nulls'])).tolist()
+				
+				if 'offsets' in column:
+					offsets = tdcli.numpy.load(os.path.join(output,column['offsets'])).tolist()
+					values = [values[offsets[i]:offsets[i+1]].tobytes() for i in range(0,len(nulls))]
+				else:
+					values = values.tolist()
+				
+				self.assertEqual(nulls,[v is None for v in expected])
+				self.assertEqual([v for v,null in zip(values,nulls) if null is False],
+								 [v for v in expected if v is not None])
+			
+			self.assertEqual(columns[2]['scale'],2)
+			shutil.rmtree(output)
+	
+	def test_arrow(self):
+		"""fexp_to_columns arrow output"""
+		
+		try:
+			import pyarrow
+		except ImportError:
+			self.skipTest('pyarrow not installed')
+		
+		for ddf in [self.fixed,self.ddf]:
+			output = os.path.join(self.dir,'export.arrow')
+			self.assertEqual(self.convert(ddf,'arrow',output),len(self.rows))
+			
+			table = pyarrow.ipc.open_file(pyarrow.memory_map(output)).read_all()
+			
+			self.assertEqual([c.to_pylist() for c in table.columns],self.expected(ddf))
+			self.assertEqual(table.schema.field('DEC').metadata[b'scale'],b'2')
+			os.remove(output)
+
+	def test_parts(self):
+		"""fexp_parts_to_csv merged and separate part files"""
+		
+		args = argparse.Namespace(use_column_titles=False,verbose=False,output=os.path.join(self.dir,'whole.csv'))
+		tdcli.fexp_to_csv(self.ddf,self.export(self.ddf),args)
+		
+		with open(args.output) as f:
+			whole = list(csv.reader(f))
+		
+		for keep_parts in [False,True]:
+			parts = []
+			for i in range(0,3):
+				parts.append(os.path.join(self.dir,'part{0}.raw'.format(i)))
+				os.rename(self.export(self.ddf),parts[-1])
+			
+			args.output = os.path.join(self.dir,'parts.csv')
+			self.assertEqual(tdcli.fexp_parts_to_csv(self.ddf,iter(parts),args,2,keep_parts),3 * len(self.rows))
+			self.assertEqual([p for p in parts if os.path.exists(p)],[])
+			
+			if keep_parts is True:
+				for i in range(0,3):
+					with open(tdcli.csv_part_file(args.output,i)) as f:
+						self.assertEqual(list(csv.reader(f)),whole)
+			else:
+				with open(args.output) as f:
+					self.assertEqual(list(csv.reader(f)),whole + whole[1:] * 2)
+				os.remove(args.output)
+
+class TestCSVSplit(unittest.TestCase):
+	
+	def test_split(self):
+		"""split_csv_file quoted newlines"""
+		
+		rows = []
+		for i in range(0,random.randint(1,200)):
+			rows.append([random.choice(['a','"b"','c\nd','e,\n"f"\n','']) for c in range(0,3)])
+		
+		fd,csv_file = tempfile.mkstemp()
+		
+		with os.fdopen(fd,'wb') as out:
+			w = csv.writer(out)
+			w.writerow(['x\ny','z','"w"'])
+			w.writerows(rows)
+		
+		try:
+			for parts in [1,2,7,500]:
+				read = []
+				
+				with open(csv_file,'rb') as f:
+					for start,end,lines_before in tdcli.split_csv_file(csv_file,parts):
+						reader = csv.reader(tdcli.read_csv_range(f,start,end))
+						read.extend(reader)
+				
+				self.assertEqual(read,rows)
+		finally:
+			os.remove(csv_file)
+	
+	def test_parts_error_line(self):
+		"""an encoding error in a csv_to_fexp_parts worker reports the line
+		number in the original csv file"""
+		
+		d = tempfile.mkdtemp()
+		csv_file = os.path.join(d,'t.csv')
+		
+		#each row is two lines long, row 900 ends on line 1 + 2 * 901
+		with open(csv_file,'wb') as out:
+			w = csv.writer(out)
+			w.writerow(['a','b'])
+			w.writerows([[i if i != 900 else 'bad','x\ny'] for i in range(0,1000)])
+		
+		ddf = [tdemu.field('a','INTEGER',4),tdemu.field('b','VARCHAR',10)]
+		
+		try:
+			for workers in [1,4]:
+				args = argparse.Namespace(use_column_titles=False,verbose=False,workers=workers,dest='t')
+				try:
+					tdcli.csv_to_fexp(ddf,csv_file,os.path.join(d,'t.fexp'),args)
+					self.fail('bad value encoded')
+				except ValueError as e:
+					self.assertTrue(str(e).endswith('(line 1803)'),str(e))
+		finally:
+			shutil.rmtree(d)
+	
+	def test_stream_error(self):
+		"""csv_to_fexp calls on_error before a bad row closes the fifo, so
+		the load can be stopped before it sees the end of the data"""
+		
+		d = tempfile.mkdtemp()
+		csv_file = os.path.join(d,'t.csv')
+		fifo = os.path.join(d,'t.fifo')
+		os.mkfifo(fifo)
+		
+		with open(csv_file,'wb') as out:
+			w = csv.writer(out)
+			w.writerow(['a'])
+			w.writerows([[i] for i in range(0,50000)])
+			w.writerow(['bad'])
+		
+		events = []
+		
+		def load():
+			with open(fifo,'rb') as f:
+				while len(f.read(65536)) > 0:
+					pass
+			events.append('eof')
+		
+		t = threading.Thread(target=load)
+		t.daemon = True
+		t.start()
+		
+		try:
+			args = argparse.Namespace(use_column_titles=False,verbose=False,workers=1,dest='t')
+			self.assertRaises(Exception,tdcli.csv_to_fexp,[tdemu.field('a','INTEGER',4)],csv_file,fifo,args,
+							  lambda e: events.append('error'))
+			t.join(10)
+		finally:
+			shutil.rmtree(d)
+		
+		self.assertEqual(events,['error','eof'])
+	
+	def test_scan(self):
+		"""scan_csv merged, limited and sampled column stats"""
+		
+		rows = []
+		for i in range(0,500):
+			rows.append([str(random.randint(-999,999)),random.choice(['','12345.678','-0.5']),
+						 random.choice(['a\nb','"c"','','2012-01-01'])])
+		
+		fd,csv_file = tempfile.mkstemp()
+		
+		with os.fdopen(fd,'wb') as out:
+			w = csv.writer(out)
+			w.writerow(['i','d','c'])
+			w.writerows(rows)
+		
+		try:
+			columns,scanned,total = tdcli.scan_csv(csv_file)
+			self.assertEqual((scanned,total),(500,500))
+			self.assertEqual(columns[0].types,{'INT':500})
+			self.assertEqual((columns[1].prec,columns[1].scale),(8,3))
+			self.assertEqual(sum(columns[2].types.values()),500)
+			
+			for workers in [2,7]:
+				merged,scanned,total = tdcli.scan_csv(csv_file,workers=workers)
+				self.assertEqual((scanned,total),(500,500))
+				for c,m in zip(columns,merged):
+					self.assertEqual((c.Name,c.types,c.min_length,c.max_length,c.prec,c.scale),
+									 (m.Name,m.types,m.min_length,m.max_length,m.prec,m.scale))
+			
+			columns,scanned,total = tdcli.scan_csv(csv_file,maxrows=100)
+			self.assertEqual((scanned,total),(100,None))
+			
+			columns,scanned,total = tdcli.scan_csv(csv_file,sample=50,workers=3)
+			self.assertEqual((scanned,total),(50,500))
+			self.assertEqual(columns[0].types,{'INT':50})
+		finally:
+			os.remove(csv_file)
+	
+	def test_sketches(self):
+		"""column_stats frequent values and distinct estimates"""
+		
+		values = [str(i) for i in range(0,20000)] + ['hot'] * 3000 + ['warm'] * 500
+		random.shuffle(values)
+		
+		whole = tdcli.column_stats('x')
+		halves = [tdcli.column_stats('x'),tdcli.column_stats('x')]
 		
+		for i,v in enumerate(values):
+			whole.insert(v)
+			halves[i % 2].insert(v)
+		
+		halves[0].merge(halves[1])
+		
+		for c in [whole,halves[0]]:
+			frequent = c.frequent(100)
+			self.assertEqual([v for v,n in frequent],['hot','warm'])
+			self.assertTrue(2900 <= frequent[0][1] <= 3000)
+			self.assertTrue(16000 < c.distinct() < 24000)
+			self.assertTrue(len(c.counts) <= 2 * c.top_k)
+		
+		small = tdcli.column_stats('x')
+		for v in ['a','b','a','','a']:
+			small.insert(v)
+		
+		self.assertEqual(small.frequent(),[('a',3),('b',1)])
+		self.assertEqual(small.distinct(),2)
+	
+	def test_merge_samples(self):
+		"""merge_samples draws in proportion to each population"""
+		
+		samples = [(['a'] * 10,1000),(['b'] * 10,10),([],0)]
+		
+		merged = tdcli.merge_samples(samples,10)
+		self.assertEqual(len(merged),10)
+		self.assertTrue(merged.count('a') >= 7)
+		self.assertEqual(sorted(tdcli.merge_samples(samples[1:],20)),['b'] * 10)
 
 class TestTDTypes(unittest.TestCase):
 	
@@ -394,13 +1402,136 @@ class TestTDTypes(unittest.TestCase):
 			ruh = tdcli.row_unpack_handler(row_data[2:],len(items))
 			row_items = ruh.unpack_row(td_types,row_data[2:],row_length)
 			
+			#the compiled decoder must agree with the row_unpack_handler
+			decoder = tdcli.row_decoder(td_types)
+			self.assertEqual(decoder.decode(row_data[2:],row_length),row_items)
+			
 			for input in items:
 				output = row_items.pop(0)
 				self.assertEqual(input,output)
 				
 			i += 1
+	
+	def test_conversion_cache(self):
+		"""conversion_cache bounds, counters and memoised td_types"""
+		
+		calls = []
+		cache = tdcli.conversion_cache(lambda v: calls.append(v) or v * 2,size=10)
+		
+		for v in [1,2,1,1,3,2]:
+			self.assertEqual(cache(v),v * 2)
+		self.assertEqual((cache.hits,cache.misses),(3,3))
+		
+		for v in range(0,100):
+			cache(v)
+		self.assertTrue(len(cache.young) + len(cache.old) <= 10)
+		
+		self.assertEqual(cache.enabled,True)
+		
+		#no hits, so it stops caching
+		cache = tdcli.conversion_cache(lambda v: v * 2,size=10)
+		for v in range(0,100):
+			self.assertEqual(cache(v),v * 2)
+		self.assertEqual(cache.enabled,False)
+		self.assertEqual(cache.misses,10)
+		
+		td_type = tdcli.type_decimal(self.dummy_ddf('DECIMAL',[9,2]))
+		for r in ['1.50','-0.05','1.50']:
+			self.assertEqual(td_type.convert(td_type.encode(r)),r.replace('-0.','-.'))
+		self.assertEqual(td_type.cache_stats(),[('encode',1,2),('convert',1,2)])
+	
+	def test_row_encoder(self):
+		"""row_encoder agrees with row_pack_handler"""
+		
+		ddfs = [self.dummy_ddf(t,l) for t,l in [('INTEGER',4),('SMALLINT',2),('BYTEINT',1),('DATE',None),
+					('FLOAT',8),('CHAR',5),('VARCHAR',300),('DECIMAL',[9,2]),('DECIMAL',[18,0])]]
+		random.shuffle(ddfs)
+		td_types = tdcli.get_td_types(ddfs)
+		
+		rows = []
+		expected = ''
+		
+		for i in range(0,random.randint(1,100)):
+			rph = tdcli.row_pack_handler()
+			row = []
 			
+			for td_type in td_types:
+				
+				if td_type.fd['Type'] == 'DECIMAL':
+					value = str(random.randint(-10 ** 7,10 ** 7))
+				elif td_type.fd['Type'] == 'CHAR':
+					value = ISO8859(random.randint(0,5))
+				elif td_type.fd['Type'] == 'VARCHAR':
+					value = ISO8859(random.randint(0,300))
+				else:
+					value = str(getattr(self,'gen_{0}'.format(td_type.fd['Type'].lower()))()[1])
+				
+				null = random.randint(0,3) == 0 and td_type.fd['Type'] not in ['CHAR','VARCHAR']
+				
+				if null is True:
+					rph.add_data(td_type,0)
+					row.append('')
+				else:
+					rph.pack(td_type,value)
+					row.append(value)
+				
+				rph.define_null(null)
 			
+			expected += rph.pack_row(len(td_types))
+			rows.append(row)
+		
+		out = StringIO.StringIO()
+		csv.writer(out).writerows(rows)
+		out.seek(0)
+		
+		encoded = StringIO.StringIO()
+		encoder = tdcli.row_encoder(td_types,batch_size=random.randint(1,1000))
+		self.assertEqual(encoder.encode_rows(csv.reader(out),encoded),len(rows))
+		self.assertEqual(encoded.getvalue(),expected)
+	
+	def test_block_decoder(self):
+		"""block_decoder agrees with row_decoder"""
+		
+		if tdcli.load_numpy() is None:
+			self.skipTest('numpy not installed')
+		
+		ddfs = [self.dummy_ddf(t,l) for t,l in [('INTEGER',4),('SMALLINT',2),('BYTEINT',1),
+					('DATE',None),('FLOAT',8),('CHAR',5),('DECIMAL',[9,2]),('DECIMAL',[18,0]),('DECIMAL',[4,4])]]
+		random.shuffle(ddfs)
+		td_types = tdcli.get_td_types(ddfs)
+		
+		def value(fd):
+			if fd['Type'] == 'CHAR':
+				return ISO8859(5)
+			elif fd['Type'] == 'DECIMAL':
+				precision,scale = fd['Len']
+				digits = str(random.randint(0,10 ** precision - 1)).zfill(precision)
+				return random.choice(['','-']) + digits[:precision - scale] + '.' + digits[precision - scale:]
+			return getattr(self,'gen_{0}'.format(fd['Type'].lower()))()[1]
+		
+		records = []
+		
+		for i in range(0,random.randint(1,200)):
+			rph = tdcli.row_pack_handler()
+			for td_type in td_types:
+				rph.pack(td_type,value(td_type.fd))
+				rph.define_null(bool(random.randint(0,1)))
+			records.append(rph.pack_row(len(td_types)))
+		
+		#the last record may be missing its newline
+		data = ''.join(records)
+		if random.randint(0,1) == 1:
+			data = data[:-1]
+		
+		expected = StringIO.StringIO()
+		tdcli.write_csv_rows(tdcli.row_decoder(td_types),tdcli.raw_reader(StringIO.StringIO(data)),csv.writer(expected))
+		
+		decoded = StringIO.StringIO()
+		decoder = tdcli.block_decoder(td_types,block_size=tdcli.fixed_record_size(td_types) * 7)
+		self.assertEqual(decoder.write_csv_rows(StringIO.StringIO(data),csv.writer(decoded)),len(records))
+		self.assertEqual(decoded.getvalue(),expected.getvalue())
+		
+		self.assertRaises(Exception,decoder.write_csv_rows,StringIO.StringIO(data[:-2]),csv.writer(decoded))
 
 if __name__ == '__main__':
 	unittest.main()
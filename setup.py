@@ -169,7 +169,7 @@ s = setup(
 	keywords = "teradata bteq fastexport multiload csv sql",
 	url = "https://github.com/xlfe/dwhwrapper",
 	scripts= ['dwhwrapper/dwh'],
-	py_modules=['tdcli','dbcarea'],
+	py_modules=['tdcli','dbcarea','tdbroker','tdjobs','tdmetrics'],
 	package_dir={'':'dwhwrapper'},
 	classifiers=[
 		"Development Status :: 3 - Alpha",
@@ -177,11 +177,11 @@ s = setup(
 #		"License :: OSI Approved :: GNU General Public License v3 (GPLv3)",  - Not yet in trove?
 		"Environment :: Console",
 		"Operating System :: POSIX :: Linux",
-		"Programming Language :: Python :: 2.6",
+		"Programming Language :: Python :: 2.7",
 		"Topic :: Database :: Front-Ends",
 		"Topic :: Utilities"
 	],
-	requires=['python (==2.6)','cliv2'],
+	requires=['python (==2.7)','cliv2'],
 	cmdclass = {'build_py': dwhwrapper_custom_setup
 				,'install_scripts':custom_install
 				,'install_lib':custom_install_lib